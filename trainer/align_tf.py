@@ -0,0 +1,214 @@
+"""
+The slider CAPTCHA alignment heuristic of captcha_aligner.py, as batched TensorFlow ops.
+
+It finds the same offsets and composites the same images as captcha_aligner.align_images(), but for a whole batch
+of foreground/background pairs at once, inside a tf.data pipeline. This lets main.py train straight on the records
+of the CAPTCHA saver script (see load_saver_records()), without aligning them and writing them to disk first.
+
+The offsets are scored as a cross-correlation: for every edge pixel of the holes, a matching background pixel adds 1,
+so the score of an offset is a constant plus the sum of +1 (white wanted) / -1 (black wanted) weights over the white
+background pixels under the edges. That sum is a depthwise convolution of the background with the weights.
+"""
+import json
+
+from typing import Iterator
+
+import tensorflow as tf
+
+from common import encode_image, encode_label, is_training_label
+from decode_jsons import decode_data_uri_bytes, iter_tasks
+
+def to_bw(px: tf.Tensor) -> tf.Tensor:
+    """
+    Determine whether pixels are closer to black or white, like captcha_aligner.to_bw().
+    @param px uint8 tensor of pixels, with the (r, g, b[, a]) channels in the last axis.
+    @return bool tensor, True where a pixel is closer to white.
+    """
+    return tf.reduce_sum(tf.cast(px[..., :3], tf.int32), axis=-1) > 384
+
+def score_offsets(bg: tf.Tensor, fg: tf.Tensor, bg_widths: tf.Tensor = None) -> tf.Tensor:
+    """
+    Heuristically score every background slide offset, like captcha_aligner.score_offsets().
+
+    @param bg uint8 (batch, height, bg_width, 4) tensor of the backgrounds, padded on the right to the widest one.
+    @param fg uint8 (batch, height, width, 4) tensor of the foregrounds, which must all be the same size.
+    @param bg_widths int32 (batch,) tensor of the real widths of the backgrounds. Defaults to bg_width for all of them.
+    @return int32 (batch, bg_width - width) tensor with the number of edge pixels that match at each offset,
+            or -1 for offsets past the end of a background.
+    """
+    batch, height, width = tf.unstack(tf.shape(fg)[:3])
+    bg_width = tf.shape(bg)[2]
+    max_delta = bg_width - width
+
+    trans = fg[..., 3] < 128
+
+    # Only columns 1..width-2 have a pixel on both sides.
+    left_trans = trans[:, :, :-2]
+    edges = trans[:, :, 1:-1] & (left_trans != trans[:, :, 2:])
+
+    bw = to_bw(fg)
+    colors = tf.where(left_trans, bw[:, :, 2:], bw[:, :, :-2])
+
+    edges = tf.cast(edges, tf.float32)
+    colors = tf.cast(colors, tf.float32)
+    weights = edges * (2 * colors - 1)
+    constant = tf.reduce_sum(edges * (1 - colors), axis=[1, 2])
+
+    # One channel per (sample, row), so every row is correlated with its own weights.
+    # Column x + 1 of the foreground lies over column x + 1 + offset of the background.
+    bg_bw = tf.cast(to_bw(bg[:, :, 1:]), tf.float32)
+    signal = tf.reshape(tf.transpose(tf.reshape(bg_bw, [batch * height, bg_width - 1])),
+                        [1, 1, bg_width - 1, batch * height])
+    kernel = tf.reshape(tf.transpose(tf.reshape(weights, [batch * height, width - 2])),
+                        [1, width - 2, batch * height, 1])
+    correlation = tf.nn.depthwise_conv2d(signal, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+    # (1, 1, max_delta + 1, batch * height) -> (batch, max_delta), summed over the rows.
+    correlation = tf.reshape(correlation[0, 0, :max_delta], [max_delta, batch, height])
+    scores = tf.transpose(tf.reduce_sum(correlation, axis=2)) + constant[:, None]
+    # The counts are small integers, so they are exact in float32.
+    scores = tf.cast(tf.round(scores), tf.int32)
+
+    if bg_widths is None:
+        return scores
+
+    valid = tf.range(max_delta)[None, :] < (bg_widths - width)[:, None]
+    return tf.where(valid, scores, -1)
+
+def find_best_offsets(bg: tf.Tensor, fg: tf.Tensor, bg_widths: tf.Tensor = None) -> tf.Tensor:
+    """
+    Run the heuristic on a batch of backgrounds and foregrounds, like captcha_aligner.find_best_offset().
+    Takes the same arguments as score_offsets().
+    @return int32 (batch,) tensor of the x-offset of the best alignment of each pair, or 0 if a background
+            isn't wider than its foreground.
+    """
+    scores = score_offsets(bg, fg, bg_widths)
+    best = tf.reduce_max(scores, axis=1, keepdims=True)
+
+    # Pick the first of equally scored offsets, like np.argmax() does. tf.argmax() doesn't promise which.
+    positions = tf.broadcast_to(tf.range(tf.shape(scores)[1]), tf.shape(scores))
+    offsets = tf.reduce_min(tf.where(scores == best, positions, tf.int32.max), axis=1)
+
+    return tf.where(best[:, 0] >= 0, offsets, 0)
+
+def combine(bg: tf.Tensor, fg: tf.Tensor, offsets: tf.Tensor) -> tf.Tensor:
+    """
+    Combine a batch of backgrounds and foregrounds at the given x-offsets, like captcha_aligner.combine().
+    The foreground is blended over the background by its alpha, with the same rounding as PIL's paste().
+
+    @param bg uint8 (batch, height, bg_width, 4) tensor of the backgrounds.
+    @param fg uint8 (batch, height, width, 4) tensor of the foregrounds.
+    @param offsets int32 (batch,) tensor of the offsets to align each pair at.
+    @return uint8 (batch, height, width, 4) tensor of the combined images.
+    """
+    width = tf.shape(fg)[2]
+    columns = offsets[:, None] + tf.range(width)[None, :]
+    crop = tf.cast(tf.gather(bg, columns, axis=2, batch_dims=1), tf.int32)
+
+    pixels = tf.cast(fg, tf.int32)
+    alpha = pixels[..., 3:]
+
+    # PIL's DIV255 of crop * (255 - alpha) + fg * alpha, a rounded division by 255.
+    blend = crop * (255 - alpha) + pixels * alpha + 128
+    blend = (tf.bitwise.right_shift(blend, 8) + blend) // 256
+
+    return tf.cast(blend, tf.uint8)
+
+def align_images(bg: tf.Tensor, fg: tf.Tensor, bg_widths: tf.Tensor = None) -> tf.Tensor:
+    """
+    Run the heuristic on a batch of backgrounds and foregrounds, and return the combined images.
+    Takes the same arguments as score_offsets().
+    @return uint8 (batch, height, width, 4) tensor of the aligned images.
+    """
+    return combine(bg, fg, find_best_offsets(bg, fg, bg_widths))
+
+def iter_saver_records(inputs: list[str], split: str = None, train_fraction=0.9) -> Iterator[tuple[bytes, bytes, str]]:
+    """
+    Lazily read the records of the CAPTCHA saver script, like decode_jsons.py does, without decoding their images.
+    Unreadable records are skipped.
+
+    @param inputs List of directories, .json files, .jsonl files, or - for JSONL on stdin.
+    @param split 'train' or 'validation' to only yield the records of that split, based on a hash of the solution
+                 like common.split_paths(), or None for all of them.
+    @param train_fraction What fraction of the data to use for training vs evaluation.
+    @return Iterator of (foreground PNG, background PNG or b'' if there's no background, solution) tuples.
+    """
+    for kind, payload, _ in iter_tasks(inputs, None):
+        try:
+            if kind == 'path':
+                with open(payload, 'rb') as fp:
+                    payload = fp.read()
+
+            data = json.loads(payload)
+            label = data['sol'].upper()
+
+            if split is not None and is_training_label(label, train_fraction) != (split == 'train'):
+                continue
+
+            fg = decode_data_uri_bytes(data['fg'])
+            bg = decode_data_uri_bytes(data['bg']) if data['bg'] is not None else b''
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+
+        yield fg, bg, label
+
+def load_saver_records(inputs: list[str], split: str = None, train_fraction=0.9, shard: tuple[int, int] = None,
+                       batch_size=32, shuffle=True) -> tf.data.Dataset:
+    """
+    Load an unbatched tf.data.Dataset of encoded samples straight from the records of the CAPTCHA saver script.
+    The slider CAPTCHAs are aligned with align_images(), in batches, as a parallel map stage.
+
+    @param inputs List of directories, .json files or .jsonl files. The records are read again every epoch,
+                  so stdin can't be one of them.
+    @param split 'train', 'validation', or None for all records, see iter_saver_records().
+    @param train_fraction What fraction of the data to use for training vs evaluation.
+    @param shard Optional tuple of (count, index), to only load one worker's part of the records.
+    @param batch_size How many records to align at once. All foregrounds in a batch must be the same size,
+                      which they are for the 4Chan CAPTCHA.
+    @param shuffle Whether to shuffle the records, differently every epoch, within a window.
+                   Otherwise they come in the order they are read.
+    @return an encoded tf.data.Dataset of (image, label) samples.
+    """
+    if '-' in inputs:
+        raise ValueError('saver records can\'t be loaded from stdin, which can only be read once')
+
+    def generate():
+        yield from iter_saver_records(inputs, split, train_fraction)
+
+    signature = (
+        tf.TensorSpec(shape=(), dtype=tf.string),
+        tf.TensorSpec(shape=(), dtype=tf.string),
+        tf.TensorSpec(shape=(), dtype=tf.string),
+    )
+
+    def decode(fg: tf.Tensor, bg: tf.Tensor, label: tf.Tensor):
+        fg = tf.io.decode_png(fg, channels=4)
+        has_bg = tf.strings.length(bg) > 0
+
+        # Records without a background get a blank one, one pixel wider so there's an offset to pick.
+        bg = tf.cond(has_bg, lambda: tf.io.decode_png(bg, channels=4),
+                     lambda: tf.zeros(tf.shape(fg) + [0, 1, 0], tf.uint8))
+
+        return fg, bg, tf.shape(bg)[1], has_bg, label
+
+    def align(fg: tf.Tensor, bg: tf.Tensor, bg_widths: tf.Tensor, has_bg: tf.Tensor, labels: tf.Tensor):
+        aligned = align_images(bg, fg, bg_widths)
+        return tf.where(has_bg[:, None, None, None], aligned, fg), labels
+
+    def encode(image: tf.Tensor, label: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+        # Like decode_png(channels=3) on an aligned.png, the alpha channel is dropped.
+        return encode_image(image[..., :3]), encode_label(label)
+
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=signature)
+    if shard is not None:
+        dataset = dataset.shard(*shard)
+
+    # The records are still PNG encoded here, so a large window is cheap.
+    if shuffle:
+        dataset = dataset.shuffle(4096, reshuffle_each_iteration=True)
+
+    return dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE) \
+                  .padded_batch(batch_size) \
+                  .map(align, num_parallel_calls=tf.data.AUTOTUNE) \
+                  .unbatch() \
+                  .map(encode, num_parallel_calls=tf.data.AUTOTUNE)
@@ -0,0 +1,227 @@
+"""
+Script to benchmark the hot paths of the trainer, so performance regressions get noticed.
+
+It generates its own fixtures (fake character glyphs, backgrounds, CAPTCHA images and slider fg/bg pairs)
+in a temporary directory, so it doesn't need any of the real datasets. For every component it reports
+the throughput and latency percentiles, and it can save the results as JSON, to compare runs over time.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+import tempfile
+
+from typing import Callable
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from PIL import Image
+
+from captcha_aligner import align_images
+from common import CHARACTER_SET, ctc_decode_predictions, encode_sample
+from main import create_model
+from synthesize import LAYOUTS, GlyphBank, composite_characters, place_character_image, synthesize_captcha
+
+def make_fixtures(root: str, seed=0) -> dict:
+    """
+    Generate the fixtures for the benchmarks.
+    @param root Directory to put the fixture files in.
+    @param seed Seed for the generated data.
+    @return Dict of the fixtures, by name.
+    """
+    rng = np.random.default_rng(seed)
+
+    # A few blocky black/white glyphs per character.
+    labels_dir = os.path.join(root, 'characters')
+    for c in CHARACTER_SET[1:]:
+        os.makedirs(os.path.join(labels_dir, c))
+        for i in range(4):
+            glyph = np.kron(rng.random((10, 8)) < 0.4, np.ones((5, 5), dtype=bool))
+            cv2.imwrite(os.path.join(labels_dir, c, f"{i}.png"), np.where(glyph[..., np.newaxis], 0, 255)
+                        .astype(np.uint8).repeat(3, axis=-1))
+
+    # Speckled backgrounds, like isolate_background() produces.
+    backgrounds = [cv2.merge([np.where(rng.random((80, 300)) < 0.05, 0, 255).astype(np.uint8)] * 3)
+                   for _ in range(8)]
+
+    # CAPTCHA images named with their solutions, for encode_sample().
+    images_dir = os.path.join(root, 'images')
+    os.makedirs(images_dir)
+    image_paths = []
+    for i in range(32):
+        label = ''.join(rng.choice(CHARACTER_SET[1:], 6))
+        path = os.path.join(images_dir, f"{label}.png")
+        cv2.imwrite(path, np.where(rng.random((80, 300, 3)) < 0.3, 0, 255).astype(np.uint8))
+        image_paths.append((path, label))
+
+    # Slider pairs: a background wider than the foreground, and a foreground with transparent holes.
+    sliders = []
+    for i in range(8):
+        bg = np.where(rng.random((80, 350, 1)) < 0.5, 0, 255).astype(np.uint8).repeat(4, axis=-1)
+        bg[..., 3] = 255
+        fg = np.where(rng.random((80, 300, 1)) < 0.5, 0, 255).astype(np.uint8).repeat(4, axis=-1)
+        fg[..., 3] = np.where(np.kron(rng.random((8, 30)) < 0.3, np.ones((10, 10))), 0, 255)
+        sliders.append((Image.fromarray(bg, 'RGBA'), Image.fromarray(fg, 'RGBA')))
+
+    return {
+        'labels_dir': labels_dir,
+        'backgrounds': backgrounds,
+        'image_paths': image_paths,
+        'sliders': sliders,
+        'out_dir': tempfile.mkdtemp(dir=root),
+    }
+
+def bench(name: str, fn: Callable[[int], None], items: int, repeats: int, warmup: int) -> dict:
+    """
+    Time repeated calls of a function.
+    @param name Name of the component.
+    @param fn Function to time, called with the index of the call.
+    @param items How many items (images, samples, ...) each call processes.
+    @param repeats How many timed calls to make.
+    @param warmup How many untimed calls to make first.
+    @return Dict of the results.
+    """
+    for i in range(warmup):
+        fn(i)
+
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    result = {
+        'name': name,
+        'calls': repeats,
+        'items_per_call': items,
+        'items_per_second': items * repeats / (latencies.sum() / 1000),
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        },
+    }
+
+    print(f"{name:<24}{result['items_per_second']:12.1f} items/s"
+          f"{result['latency_ms']['p50']:10.2f}{result['latency_ms']['p90']:10.2f}"
+          f"{result['latency_ms']['p99']:10.2f} ms (p50/p90/p99)")
+
+    return result
+
+def benchmarks(fixtures: dict, batch_size: int) -> dict[str, tuple[Callable[[int], None], int]]:
+    """
+    Set up the benchmarked components.
+    @return Dict of component name to (function, items per call).
+    """
+    glyphs = GlyphBank(fixtures['labels_dir'])
+    backgrounds = fixtures['backgrounds']
+    image_paths = fixtures['image_paths']
+    sliders = fixtures['sliders']
+    layout = LAYOUTS[0]
+
+    def encode(i: int):
+        path, label = image_paths[i % len(image_paths)]
+        encode_sample(path, label)
+
+    def align(i: int):
+        bg, fg = sliders[i % len(sliders)]
+        align_images(bg, fg)
+
+    def synthesize(i: int):
+        label = ''.join(random.choice(CHARACTER_SET[1:]) for _ in layout['x'])
+        synthesize_captcha(backgrounds[i % len(backgrounds)], layout['x'], layout['y'], layout['size'], label,
+                           fixtures['out_dir'], glyphs)
+
+    def place(i: int):
+        place_character_image(backgrounds[i % len(backgrounds)].copy(), glyphs.sample('A', layout['size']),
+                              layout['x'][i % 6], layout['y'][i % 6])
+
+    def composite(i: int):
+        label = ''.join(random.choice(CHARACTER_SET[1:]) for _ in layout['x'])
+        composite_characters(backgrounds[i % len(backgrounds)].copy(),
+                             [(*glyphs.sample_masked(c, layout['size']), x, y)
+                              for c, x, y in zip(label, layout['x'], layout['y'])])
+
+    rng = np.random.default_rng(0)
+    predictions = tf.nn.softmax(rng.normal(size=(batch_size, 38, len(CHARACTER_SET) + 1)) * 4).numpy()
+
+    def decode(i: int):
+        ctc_decode_predictions(predictions)
+
+    model = create_model()
+    images = tf.constant(rng.random((batch_size, 300, 80, 1)) < 0.5, dtype=tf.float32)
+    labels = tf.constant(rng.integers(1, len(CHARACTER_SET), (batch_size, 6)), dtype=tf.int64)
+
+    def forward(i: int):
+        model.predict_on_batch(images)
+
+    def train_step(i: int):
+        model.train_on_batch(images, labels)
+
+    return {
+        'encode_sample': (encode, 1),
+        'align_images': (align, 1),
+        'synthesize_captcha': (synthesize, 1),
+        'place_character_image': (place, 1),
+        'composite_characters': (composite, len(layout['x'])),
+        'ctc_decode_predictions': (decode, batch_size),
+        'model_forward': (forward, batch_size),
+        'model_train_step': (train_step, batch_size),
+    }
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Benchmarks the trainer hot paths on locally generated fixtures.'
+    )
+    parser.add_argument('-o', '--out', action='store', default=None,
+                        help='Save the results as JSON to this file.')
+    parser.add_argument('-c', '--component', action='append', default=None,
+                        help='Only run this component. Can be given more than once. Defaults to all of them.')
+    parser.add_argument('-r', '--repeats', action='store', type=int, default=50,
+                        help='How many timed calls to make per component. Defaults to 50.')
+    parser.add_argument('--warmup', action='store', type=int, default=3,
+                        help='How many untimed calls to make per component first. Defaults to 3.')
+    parser.add_argument('-b', '--batch-size', action='store', type=int, default=16,
+                        help='Batch size for the decoding and model benchmarks. Defaults to 16.')
+
+    args = parser.parse_args(argv[1:])
+
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as root:
+        fixtures = make_fixtures(root)
+        components = benchmarks(fixtures, args.batch_size)
+
+        names = args.component or list(components)
+        unknown = set(names) - set(components)
+        if unknown:
+            print(f"Unknown components: {', '.join(sorted(unknown))}. Choose from: {', '.join(components)}")
+            return 1
+
+        results = [bench(name, *components[name], args.repeats, args.warmup) for name in names]
+
+    if args.out is not None:
+        with open(args.out, 'w') as fp:
+            json.dump({
+                'timestamp': datetime.datetime.now().isoformat(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'tensorflow': tf.__version__,
+                'cpu_count': os.cpu_count(),
+                'batch_size': args.batch_size,
+                'results': results,
+            }, fp, indent=2)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,174 @@
+"""
+A bit-packed cache of encoded samples.
+
+encode_sample() produces images of only 0s and 1s, but as float32, which is 96 KB per sample.
+Packed 8 pixels to a byte, the same image takes 3 KB, so even very large datasets fit in RAM,
+or in a memory-mapped file that the page cache keeps hot. Batches are unpacked inside the input pipeline.
+"""
+import os
+import hashlib
+
+import numpy as np
+import tensorflow as tf
+
+IMAGE_SHAPE = (300, 80, 1)
+PACKED_SIZE = IMAGE_SHAPE[0] * IMAGE_SHAPE[1] // 8
+LABEL_LENGTH = 6
+
+def pack_images(images: np.ndarray) -> np.ndarray:
+    """
+    Pack a batch of encoded images into bits.
+    @param images (batch, 300, 80, 1) array of 0s and 1s.
+    @return (batch, 3000) uint8 array.
+    """
+    return np.packbits(images.reshape(len(images), -1) > 0.5, axis=1)
+
+def unpack_images(bits: tf.Tensor) -> tf.Tensor:
+    """
+    Unpack a batch of images packed by pack_images().
+    @param bits (batch, 3000) uint8 tensor.
+    @return (batch, 300, 80, 1) float32 tensor of 0s and 1s, as encode_sample() produces.
+    """
+    # np.packbits() puts the first pixel in the highest bit.
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    unpacked = tf.bitwise.bitwise_and(tf.bitwise.right_shift(bits[..., tf.newaxis], shifts), 1)
+
+    return tf.cast(tf.reshape(unpacked, (-1, *IMAGE_SHAPE)), tf.float32)
+
+def cache_fingerprint(sources: list[str], count: int = None) -> str:
+    """
+    Fingerprint what a cache is built from, so BitCache.build() doesn't reuse a cache of other samples.
+    @param sources The image paths, packed dataset directories or saver records the samples are read from.
+                   Each is fingerprinted along with its size and modification time, since an image can be saved
+                   again under the same name, and more samples can be added to the others.
+    @param count The number of samples, if it is known before building the cache.
+    @return The fingerprint, as a hex string.
+    """
+    digest = hashlib.sha1(f"{count}\n".encode('utf-8'))
+    for source in sorted(sources):
+        digest.update(f"{source}\n".encode('utf-8'))
+
+        if os.path.exists(source):
+            stat = os.stat(source)
+            digest.update(f"{stat.st_size} {stat.st_mtime_ns}\n".encode('utf-8'))
+
+    return digest.hexdigest()
+
+class BitCache:
+    """ Bit-packed images and their labels, in RAM or memory-mapped from disk. """
+
+    def __init__(self, bits: np.ndarray, labels: np.ndarray):
+        """
+        @param bits (count, 3000) uint8 array of images packed by pack_images().
+        @param labels (count, 6) uint8 array of encoded labels.
+        """
+        self.bits = bits
+        self.labels = labels
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, dataset: tf.data.Dataset, path: str = None, chunk_size=1024, fingerprint: str = None) -> 'BitCache':
+        """
+        Build a cache by running through a dataset of encoded samples once.
+        @param dataset Unbatched tf.data.Dataset of (image, label) samples, as encode_sample() produces.
+        @param path Where to store the cache, or None to keep it in RAM.
+                    If the cache already exists there, it is loaded instead of built.
+        @param chunk_size How many samples to pack at a time.
+        @param fingerprint The cache_fingerprint() of the dataset's sources, stored with the cache. An existing cache
+                           with another fingerprint, or none, is built again instead of loaded.
+        """
+        if path is not None and os.path.exists(path + '.labels.npy'):
+            stored = None
+            if os.path.exists(path + '.fingerprint'):
+                with open(path + '.fingerprint', 'r') as fp:
+                    stored = fp.read().strip()
+
+            if fingerprint is None or stored == fingerprint:
+                return cls.load(path)
+
+            print(f"The cache at {path} was built from other samples, building it again.")
+            # The labels go first, so an interrupted rebuild never leaves a cache that looks complete.
+            for ext in ('.labels.npy', '.fingerprint'):
+                if os.path.exists(path + ext):
+                    os.remove(path + ext)
+
+        bits = []
+        labels = []
+        out = open(path + '.bits', 'wb') if path is not None else None
+
+        try:
+            for images, label_batch in dataset.batch(chunk_size).as_numpy_iterator():
+                packed = pack_images(images)
+                if out is not None:
+                    out.write(packed.tobytes())
+                else:
+                    bits.append(packed)
+
+                labels.append(label_batch.astype(np.uint8))
+        finally:
+            if out is not None:
+                out.close()
+
+        labels = np.concatenate(labels) if labels else np.zeros((0, LABEL_LENGTH), dtype=np.uint8)
+
+        if path is None:
+            return cls(np.concatenate(bits) if bits else np.zeros((0, PACKED_SIZE), dtype=np.uint8), labels)
+
+        if fingerprint is not None:
+            with open(path + '.fingerprint', 'w') as fp:
+                fp.write(fingerprint + '\n')
+
+        # The labels are written last, so their presence marks a complete cache.
+        np.save(path + '.labels.npy', labels)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> 'BitCache':
+        """
+        Memory-map a cache previously built with BitCache.build().
+        @param path The path the cache was built at.
+        """
+        labels = np.load(path + '.labels.npy')
+        if len(labels) == 0:
+            return cls(np.zeros((0, PACKED_SIZE), dtype=np.uint8), labels)
+
+        bits = np.memmap(path + '.bits', dtype=np.uint8, mode='r', shape=(len(labels), PACKED_SIZE))
+
+        return cls(bits, labels)
+
+    def dataset(self, batch_size=16, shuffle=True, indices: tf.data.Dataset = None) -> tf.data.Dataset:
+        """
+        Get a batched tf.data.Dataset of the cached samples.
+        Batches are gathered from the cache by index and unpacked in the pipeline,
+        so the cache itself is never copied into the graph.
+        @param batch_size The batch size to use for the dataset.
+        @param shuffle Whether to shuffle the samples, differently every epoch.
+        @param indices Optional unbatched tf.data.Dataset of the int64 indices of the samples to load, instead of
+                       every sample once. The samples of each batch come out sorted by index.
+        @return tf.data.Dataset of (image, label) batches, as encode_sample() would produce.
+        """
+        def gather(indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            # Sorted indices read the memory map mostly front to back.
+            indices = np.sort(indices)
+            return self.bits[indices], self.labels[indices].astype(np.int64)
+
+        def load_batch(indices: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+            bits, labels = tf.numpy_function(gather, [indices], [tf.uint8, tf.int64])
+            bits.set_shape((None, PACKED_SIZE))
+            labels.set_shape((None, LABEL_LENGTH))
+
+            return unpack_images(bits), labels
+
+        if indices is not None:
+            dataset = indices
+        else:
+            dataset = tf.data.Dataset.range(len(self))
+
+        if indices is None and shuffle:
+            dataset = dataset.shuffle(len(self), reshuffle_each_iteration=True)
+
+        return dataset.batch(batch_size) \
+                      .map(load_batch, num_parallel_calls=tf.data.AUTOTUNE) \
+                      .prefetch(tf.data.AUTOTUNE)
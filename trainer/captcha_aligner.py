@@ -11,9 +11,18 @@ identical-colored pixels from the background image directly adjacent to them, vi
 """
 import os
 import sys
-import operator
+import json
+import time
+import argparse
+import multiprocessing
 
-from PIL import Image, ImageDraw
+import numpy as np
+
+from PIL import Image
+from timing import Timings
+
+# Default name of the progress manifest kept by the batch mode, inside the folder being aligned.
+MANIFEST_NAME = '.aligner-manifest.jsonl'
 
 
 def combine(bg: Image, fg: Image, offset: int) -> Image:
@@ -33,70 +42,79 @@ def combine(bg: Image, fg: Image, offset: int) -> Image:
     return combined
 
 
-def to_bw(px: tuple[int, int, int]) -> int:
+def to_bw(px: np.ndarray) -> np.ndarray:
     """
-    Determine whether a pixel is closer to black or white.
+    Determine whether pixels are closer to black or white.
 
-    @param px Tuple of (r, g, b) uint8 values of a pixel.
-    @return 0 if the pixel is closer to black than white, 1 otherwise.
+    @param px Array of uint8 pixel values, with the (r, g, b[, a]) channels in the last axis.
+    @return Array of 0 where a pixel is closer to black than white, 1 otherwise.
     """
-    if px[0] + px[1] + px[2] > 384:
-        return 1
+    # Sum in a wider type, three uint8 channels can overflow.
+    return (px[..., :3].sum(axis=-1, dtype=np.uint16) > 384).astype(np.uint8)
 
-    return 0
 
-
-def detect_transparent_pixels(img: Image) -> list[tuple[int, int, int]]:
+def detect_transparent_pixels(img: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Detect transparent pixels in the image, and figure out the color of the pixel to the left or right of them.
 
-    @param PIL.Image of the foreground image with transparent "holes".
-    @return list of tuples of (x, y, color of adjacent pixel), where the color is 0 for blackish or 1 for whitish.
+    @param img RGBA array (height, width, 4) of the foreground image with transparent "holes".
+    @return Tuple of (xs, ys, colors) arrays, where the color is 0 for blackish or 1 for whitish.
     """
-    pixels = []
-    for x in range(1, img.width - 1):
-        for y in range(0, img.height):
-            color = img.getpixel((x, y))
-            is_trans = color[3] < 128
+    trans = img[..., 3] < 128
 
-            if not is_trans:
-                continue
+    # Only columns 1..width-2 have a pixel on both sides.
+    center = trans[:, 1:-1]
+    left_trans = trans[:, :-2]
+    right_trans = trans[:, 2:]
 
-            left_px = img.getpixel((x - 1, y))
-            left_trans = left_px[3] < 128
-            right_px = img.getpixel((x + 1, y))
-            right_trans = right_px[3] < 128
+    # ignore transparent gaps and one-wide areas
+    edges = center & (left_trans != right_trans)
 
-            # ignore transparent gaps and one-wide areas
-            if left_trans == right_trans:
-                continue
+    bw = to_bw(img)
+    colors = np.where(left_trans, bw[:, 2:], bw[:, :-2])
 
-            if left_trans:
-                pixel = to_bw(right_px)
-            else: # right_trans
-                pixel = to_bw(left_px)
+    ys, xs = np.nonzero(edges)
 
-            pixels.append((x, y, pixel))
+    return xs + 1, ys, colors[ys, xs]
 
-    print(pixels)
-    return pixels
 
+def score_offsets(img: np.ndarray, pixels: tuple[np.ndarray, np.ndarray, np.ndarray], max_delta: int) -> np.ndarray:
+    """
+    Heuristically score every background slide offset in [0, max_delta) based on the given image
+    and pixel information.
 
-def score_offset(img: Image, pixels: list[tuple[int, int, int]], offset: int) -> int:
+    @param img RGBA array (height, width, 4) of the background image with random-looking text.
+    @param pixels Tuple of desired pixel values returned by detect_transparent_pixels().
+    @param max_delta Number of x-offsets to score.
+    @return Array of length max_delta, with the number of pixels that match the desired values at each offset.
     """
-    Heuristically score a background slide offset based on the given image and pixel information list.
+    xs, ys, colors = pixels
+    bw = to_bw(img)
+
+    # One row per edge pixel, one column per offset.
+    candidates = bw[ys[:, None], xs[:, None] + np.arange(max_delta)]
+
+    return np.count_nonzero(candidates == colors[:, None], axis=0)
+
 
-    @param img The background image with random-looking text.
-    @param pixels List of desired pixel values returned by detect_transparent_pixels().
-    @param offset X-offset of the alignment we're scoring.
-    @return Number of pixels that match the desired values in the pixels list.
+def find_best_offset(bg: Image, fg: Image) -> int:
     """
-    score = 0
-    for x, y, col in pixels:
-        if to_bw(img.getpixel((x + offset, y))) == col:
-            score += 1
+    Run the heuristic (described at the top of this file) on the given background and foreground image.
+
+    @param bg PIL.Image of the background image.
+    @param fg PIL.Image of the foreground image.
+    @return The x-offset of the best alignment.
+    """
+    max_delta = bg.width - fg.width
+    if max_delta <= 0:
+        raise ValueError(f"background ({bg.width}px) must be wider than the foreground ({fg.width}px)")
+
+    pixels = detect_transparent_pixels(np.asarray(fg.convert('RGBA')))
+    scores = score_offsets(np.asarray(bg.convert('RGBA')), pixels, max_delta)
+
+    # argmax picks the first of equally scored offsets, like a stable sort would.
+    return int(np.argmax(scores))
 
-    return score
 
 def align_images(bg: Image, fg: Image) -> Image:
     """
@@ -107,48 +125,153 @@ def align_images(bg: Image, fg: Image) -> Image:
     @param fg PIL.Image of the foreground image.
     @return PIL.Image of the aligned image.
     """
-    max_delta = bg.width - fg.width
+    return combine(bg, fg, find_best_offset(bg, fg))
+
 
-    pixels = detect_transparent_pixels(fg)
-    scores = []
+def align_folder(root: str, timings: Timings = None) -> str | None:
+    """
+    Align the bg.png and img.png of a single slider CAPTCHA folder, and save the result as aligned.png.
 
-    print(max_delta)
+    @param root Path of the folder.
+    @param timings Timings to record the load, align and save stages in.
+    @return None on success, or the error message on failure.
+    """
+    aligned_path = os.path.join(root, 'aligned.png')
+    timings = timings if timings is not None else Timings()
 
-    for offset in range(0, max_delta):
-        score = score_offset(bg, pixels, offset)
-        scores.append((offset, score))
+    try:
+        # Already did this one before we kept a manifest, no need to do it again.
+        if os.path.exists(aligned_path):
+            return None
 
-    print(scores)
-    best = sorted(
-        scores, key=operator.itemgetter(1), reverse=True
-    )[0]
+        with timings.stage('load'):
+            bg = Image.open(os.path.join(root, 'bg.png')).convert('RGBA')
+            fg = Image.open(os.path.join(root, 'img.png')).convert('RGBA')
 
-    aligned = combine(bg, fg, best[0])
-    return aligned
+        with timings.stage('align_images'):
+            aligned = align_images(bg, fg)
 
+        with timings.stage('save'):
+            aligned.save(aligned_path)
+    except Exception as e:
+        return str(e)
 
-def main(argv: list[string]) -> int:
-    if len(argv) != 2:
-        print(f"usage: {argv[0]} folder")
-        return 1
+    return None
 
-    for root in os.listdir(argv[1]):
-        root = os.path.join(argv[1], root)
-        aligned_path = os.path.join(root, 'aligned.png')
 
-        # Already did this one, no need to do it again.
-        if os.path.exists(aligned_path):
-            continue
+def _align_named_folder(args: tuple[str, str]) -> tuple[str, str | None, Timings]:
+    """
+    Pool worker wrapper around align_folder(), that keeps track of which folder the result is for,
+    and sends the folder's stage timings back.
+    """
+    folder, name = args
+    timings = Timings()
+    return name, align_folder(os.path.join(folder, name), timings), timings
 
-        try:
-            bg = Image.open(root + '/bg.png').convert('RGBA')
-            fg = Image.open(root + '/img.png').convert('RGBA')
 
-            aligned = align_images(bg, fg)
+def load_manifest(path: str) -> dict[str, str]:
+    """
+    Load the progress manifest written by a previous batch run.
 
-            aligned.save(aligned_path)
-        except Exception as e:
-            print(str(e))
+    @param path Path of the manifest, a file with one JSON object per line.
+    @return Dict of folder name to its last recorded status, either 'ok' or 'failed'.
+    """
+    statuses = {}
+    if not os.path.exists(path):
+        return statuses
+
+    with open(path, 'r') as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Probably a line cut short by an interrupted run.
+                continue
+
+            statuses[entry['name']] = entry['status']
+
+    return statuses
+
+
+def align_batch(folder: str, manifest_path: str, workers: int, chunk_size: int,
+                retry_failed: bool = False, timings: Timings = None) -> tuple[int, int, int]:
+    """
+    Align every CAPTCHA folder under the given folder, spread over a process pool.
+    Results are appended to the manifest as they come in, so an interrupted run can be resumed.
+
+    @param folder The folder containing one sub-folder per slider CAPTCHA.
+    @param manifest_path Path of the progress manifest.
+    @param workers Number of worker processes.
+    @param chunk_size Number of folders handed to a worker at a time.
+    @param retry_failed Whether to retry folders that failed in a previous run.
+    @param timings Timings to merge the stage timings of every folder into.
+    @return Tuple of (aligned, failed, skipped) folder counts.
+    """
+    statuses = load_manifest(manifest_path)
+    skip = {'ok'} if retry_failed else {'ok', 'failed'}
+
+    # scandir() gets the entry types from the directory listing itself, without a stat() per folder.
+    with os.scandir(folder) as it:
+        names = sorted(entry.name for entry in it if entry.is_dir())
+    pending = [(folder, name) for name in names if statuses.get(name) not in skip]
+    skipped = len(names) - len(pending)
+
+    aligned = 0
+    failed = 0
+
+    with open(manifest_path, 'a') as manifest, multiprocessing.Pool(workers) as pool:
+        results = pool.imap_unordered(_align_named_folder, pending, chunksize=chunk_size)
+
+        for name, error, folder_timings in results:
+            if timings is not None:
+                timings.merge(folder_timings)
+
+            if error is None:
+                aligned += 1
+                entry = {'name': name, 'status': 'ok'}
+            else:
+                failed += 1
+                entry = {'name': name, 'status': 'failed', 'error': error}
+                print(f"{name}: {error}")
+
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+
+    return aligned, failed, skipped
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Aligns every slider CAPTCHA folder (containing bg.png and img.png) into an aligned.png.'
+    )
+    parser.add_argument('folder', action='store',
+                        help='The folder containing one sub-folder per slider CAPTCHA.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=os.cpu_count(),
+                        help='How many worker processes to use. Defaults to the number of CPUs.')
+    parser.add_argument('--chunk-size', action='store', type=int, default=16,
+                        help='How many folders to hand to a worker at a time. Defaults to 16.')
+    parser.add_argument('--manifest', action='store', default=None,
+                        help=f"Path of the progress manifest. Defaults to {MANIFEST_NAME} in the folder.")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Retry folders that failed in a previous run, instead of skipping them.')
+
+    args = parser.parse_args(argv[1:])
+    manifest_path = args.manifest or os.path.join(args.folder, MANIFEST_NAME)
+
+    # The per-stage timings are printed at exit, so an interrupted run still shows them.
+    timings = Timings()
+    timings.report_at_exit()
+
+    start = time.perf_counter()
+    aligned, failed, skipped = align_batch(
+        args.folder, manifest_path, args.workers, args.chunk_size, args.retry_failed, timings
+    )
+    elapsed = time.perf_counter() - start
+
+    done = aligned + failed
+    print(f"Aligned {aligned}, failed {failed}, skipped {skipped} folders in {elapsed:.1f}s "
+          f"({done / elapsed if elapsed > 0 else 0:.1f} folders/s)")
 
     return 0
 
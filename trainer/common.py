@@ -1,31 +1,27 @@
 """
 Common functions that are used by both the training and inference code.
 """
-import os
+import functools
+
 import keras
 import numpy as np
 import tensorflow as tf
 
-CHARACTER_SET = ['', '0', '2', '4', '8', 'A', 'D', 'G', 'H', 'J', 'K', 'M',
-                'N', 'P', 'R', 'S', 'T', 'V', 'W', 'X', 'Y']
-char_to_num = keras.layers.StringLookup(vocabulary=CHARACTER_SET,
-                                        mask_token=None, oov_token='')
-num_to_char = keras.layers.StringLookup(vocabulary=char_to_num.get_vocabulary(),
-                                        invert=True, mask_token=None, oov_token='')
+# The TF-free parts live in common_lite.py, so the preprocessing tools can use them without loading TF.
+from common_lite import CHARACTER_SET, DECODE_CODES, get_file_label, is_training_label, split_paths, walk_png_files
 
-def walk_png_files(top: str) -> list[str]:
-    """
-    Walk the given directory and accumulate a list of all files ending in .png under that dir.
-    @param top The top directory to walk.
-    @return List of strs containing the paths of files ending in .png under that dir.
-    """
-    paths = []
-    for root, dirs, files in os.walk(top):
-        for file in files:
-            if file.endswith('.png'):
-                paths.append(os.path.join(root, file))
+# The lookup layers are built on first use, since building them runs TF ops, and some things
+# (like a tf.distribute strategy) have to be set up before any TF op runs.
+@functools.cache
+def get_char_to_num() -> keras.layers.StringLookup:
+    """ Get the lookup layer that encodes characters as their indices in CHARACTER_SET. """
+    return keras.layers.StringLookup(vocabulary=CHARACTER_SET, mask_token=None, oov_token='')
 
-    return paths
+@functools.cache
+def get_num_to_char() -> keras.layers.StringLookup:
+    """ Get the lookup layer that decodes indices in CHARACTER_SET back into characters. """
+    return keras.layers.StringLookup(vocabulary=get_char_to_num().get_vocabulary(),
+                                     invert=True, mask_token=None, oov_token='')
 
 def ctc_loss(y_true: tf.Tensor, y_pred: tf.Tensor):
     """ Simple CTC loss function. """
@@ -40,19 +36,106 @@ def ctc_loss(y_true: tf.Tensor, y_pred: tf.Tensor):
     loss = tf.keras.backend.ctc_batch_cost(y_true, y_pred, input_length, label_length)
     return loss
 
-def ctc_decode_predictions(pred):
+def ctc_loss_xla(y_true: tf.Tensor, y_pred: tf.Tensor):
+    """
+    The same CTC loss as ctc_loss(), built from plain TF ops, since the CTCLoss kernel it uses can't be
+    compiled with XLA. It's slower without XLA, so only use it when compiling with XLA.
+    """
+    batch_len = tf.shape(y_true)[0]
+    input_length = tf.fill([batch_len], tf.shape(y_pred)[1])
+    label_length = tf.fill([batch_len], tf.shape(y_true)[1])
+
+    # ctc_batch_cost() takes the log of the softmax output the same way, and CTC uses the last class as the blank.
+    loss = tf.nn.ctc_loss(tf.cast(y_true, tf.int32), tf.math.log(y_pred + keras.backend.epsilon()),
+                          label_length, input_length, logits_time_major=False, blank_index=-1)
+    return tf.expand_dims(loss, 1)
+
+def ctc_greedy_decode_ragged(pred: tf.Tensor) -> tf.RaggedTensor:
+    """
+    Greedily decode a batch of CTC-encoded predictions in-graph, into the character indices of each CAPTCHA.
+    Repeats are merged, then the CTC blanks and empty ('') characters are dropped.
+    @param pred (batch, time, classes) tensor of model predictions.
+    @return (batch, None) int32 RaggedTensor of character indices, as get_char_to_num() would encode them.
+    """
+    best = tf.argmax(pred, axis=-1, output_type=tf.int32)
+    previous = tf.pad(best[:, :-1], [[0, 0], [1, 0]], constant_values=-1)
+    blank = tf.shape(pred)[-1] - 1
+
+    keep = (best != previous) & (best != blank) & (best != 0)
+    return tf.ragged.boolean_mask(best, keep)
+
+@tf.function
+def ctc_batch_metrics(y_true: tf.Tensor, y_pred: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Score a batch of predictions against the encoded labels, without turning anything into strings.
+    @param y_true (batch, 6) tensor of encoded labels, as encode_sample() produces.
+    @param y_pred (batch, time, classes) tensor of model predictions.
+    @return Tuple of (number of exactly correct CAPTCHAs, total character edit distance, total label characters).
+    """
+    y_true = tf.cast(y_true, tf.int32)
+    truth = tf.ragged.boolean_mask(y_true, y_true != 0)
+    decoded = ctc_greedy_decode_ragged(y_pred)
+
+    distances = tf.edit_distance(decoded.to_sparse(), truth.to_sparse(), normalize=False)
+
+    correct = tf.reduce_sum(tf.cast(distances == 0, tf.int32))
+    return correct, tf.reduce_sum(distances), tf.reduce_sum(truth.row_lengths())
+
+def ctc_decode_predictions(pred, beam_width: int = None) -> list[str]:
     """
     Decode the CTC-encoded predictions from the model into a string of the
-    CAPTCHA characters. Uses greedy search.
+    CAPTCHA characters, for the whole batch at once.
+    @param pred (batch, time, classes) array of model predictions.
+    @param beam_width Use beam search with this many beams, instead of greedy search.
+    @return List of the decoded strings.
     """
-    input_len = np.ones(pred.shape[0]) * pred.shape[1]
-    results = tf.keras.backend.ctc_decode(pred, input_length=input_len, greedy=True)[0][0]
-    output_text = []
-    for result in results:
-        result = tf.strings.reduce_join(num_to_char(result)).numpy().decode("utf-8")
-        output_text.append(result)
+    pred = np.asarray(pred)
+
+    if beam_width is not None:
+        input_len = np.full(pred.shape[0], pred.shape[1])
+        best = tf.keras.backend.ctc_decode(pred, input_length=input_len, greedy=False,
+                                           beam_width=beam_width, top_paths=1)[0][0]
+        # Beam search results are already collapsed, and padded with -1.
+        codes = DECODE_CODES[np.asarray(best)]
+    else:
+        best = pred.argmax(axis=-1)
+
+        # Merge repeats, the blanks and empty characters are dropped by mapping them to 0.
+        codes = DECODE_CODES[best]
+        codes[:, 1:][best[:, 1:] == best[:, :-1]] = 0
 
-    return output_text
+    # Move the kept characters to the front of each row, then read every row as a NUL-padded byte string.
+    order = np.argsort(codes == 0, axis=1, kind='stable')
+    codes = np.ascontiguousarray(np.take_along_axis(codes, order, axis=1))
+
+    return codes.view(f"S{codes.shape[1]}").ravel().astype(str).tolist()
+
+
+def encode_image(data: tf.Tensor) -> tf.Tensor:
+    """
+    Encode a decoded image as input to the model.
+    @param data uint8 RGB image tensor, of shape (height, width, 3).
+    @return (300, 80, 1) float32 tensor of 0s and 1s.
+    """
+    data = tf.image.resize(data, (80, 300))
+    data = tf.image.rgb_to_grayscale(data)
+
+    # threshold to convert to pure b/w, this also normalizes it.
+    data = tf.where(data>127, tf.ones_like(data), tf.zeros_like(data))
+    return tf.transpose(data, perm=[1, 0, 2])
+
+
+def encode_label(label: str) -> tf.Tensor:
+    """
+    Encode a CAPTCHA solution as the model's training target.
+    @param label The solution text.
+    @return int64 tensor of the character indices, padded to 6 characters.
+    """
+    label = get_char_to_num()(tf.strings.unicode_split(label, input_encoding="UTF-8"))
+
+    # Pad the label with empty chars to 6 chars (the maximum length of the CAPTCHA)
+    max_label_len = 6
+    return tf.pad(label, [[0, max_label_len - tf.shape(label)[0]]], constant_values=0)
 
 
 def encode_sample(img: str, label: str = None) -> tuple[tf.Tensor, tf.Tensor]:
@@ -65,18 +148,9 @@ def encode_sample(img: str, label: str = None) -> tuple[tf.Tensor, tf.Tensor]:
     file = tf.io.read_file(img)
 
     data = tf.io.decode_png(file, channels=3)
-    data = tf.image.resize(data, (80, 300))
-    data = tf.image.rgb_to_grayscale(data)
-
-    # threshold to convert to pure b/w, this also normalizes it.
-    data = tf.where(data>127, tf.ones_like(data), tf.zeros_like(data))
-    data = tf.transpose(data, perm=[1, 0, 2])
+    data = encode_image(data)
 
     if label is not None:
-        label = char_to_num(tf.strings.unicode_split(label, input_encoding="UTF-8"))
-
-        # Pad the label with empty chars to 6 chars (the maximum length of the CAPTCHA)
-        max_label_len = 6
-        label = tf.pad(label, [[0, max_label_len - tf.shape(label)[0]]], constant_values=0)
+        label = encode_label(label)
 
     return data, label
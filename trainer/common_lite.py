@@ -0,0 +1,69 @@
+"""
+The pure-Python parts of common.py: the character set, the label tables, and the dataset file helpers.
+
+This module must not import TensorFlow, so the CPU-only tools (synthesize.py, labeler.py, the aligner and
+the background extractor) and their worker processes start in milliseconds. common.py re-exports all of it.
+"""
+import os
+import hashlib
+
+import numpy as np
+
+CHARACTER_SET = ['', '0', '2', '4', '8', 'A', 'D', 'G', 'H', 'J', 'K', 'M',
+                'N', 'P', 'R', 'S', 'T', 'V', 'W', 'X', 'Y']
+
+# ASCII code of each of the model's output classes, for decoding in NumPy. The CTC blank is the extra last class,
+# and it, the empty character, and the -1 padding (wrapping around to the blank) all map to 0.
+DECODE_CODES = np.array([ord(c) if c else 0 for c in CHARACTER_SET] + [0], dtype=np.uint8)
+
+def walk_png_files(top: str) -> list[str]:
+    """
+    Walk the given directory and accumulate a list of all files ending in .png under that dir.
+    @param top The top directory to walk.
+    @return List of strs containing the paths of files ending in .png under that dir.
+    """
+    paths = []
+    for root, dirs, files in os.walk(top):
+        for file in files:
+            if file.endswith('.png'):
+                paths.append(os.path.join(root, file))
+
+    return paths
+
+def get_file_label(file: str) -> str:
+    """
+    Get the CAPTCHA solution from the name of an image file, which must be named {sol}.png.
+    """
+    label, _ = os.path.splitext(os.path.basename(file))
+
+    return label.upper()
+
+def is_training_label(label: str, train_fraction=0.9) -> bool:
+    """
+    Decide which split a CAPTCHA solution belongs to, based on a hash of it.
+    @param label The solution text.
+    @param train_fraction What fraction of the data to use for training vs evaluation.
+    @return True if samples with this solution are for training, False if they are for evaluation.
+    """
+    digest = hashlib.sha1(label.encode('utf-8')).digest()
+
+    return int.from_bytes(digest[:8], 'big') / 2**64 < train_fraction
+
+def split_paths(paths: list[str], train_fraction=0.9) -> (list[str], list[str]):
+    """
+    Deterministically split the image paths into training and evaluation paths.
+    Each image goes to a split based on a hash of its solution, so the split is the same on every run,
+    an image keeps its split as the dataset grows, and copies of a CAPTCHA always end up in the same split.
+    @param paths The list of paths, one for each image.
+    @param train_fraction What fraction of the data to use for training vs evaluation.
+    @return Tuple of (training_paths, evaluation_paths).
+    """
+    training = []
+    validation = []
+    for path in paths:
+        if is_training_label(get_file_label(path), train_fraction):
+            training.append(path)
+        else:
+            validation.append(path)
+
+    return training, validation
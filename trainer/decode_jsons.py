@@ -1,38 +1,49 @@
 """
 This script decodes the JSON files created by my CAPTCHA saver script, aligns the foreground and background if necessary,
 and saves the resulting image files named with the solutions.
+
+It takes any mix of directories of .json files, single .json files, and JSONL files (one saver record per line,
+or - for stdin). Records are read lazily and decoded on a pool of worker processes.
 """
 import io
 import os
 import sys
 import json
+import time
 import base64
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator
 
 from PIL import Image
 from captcha_aligner import align_images
+from timing import Timings
+
+def decode_data_uri_bytes(uri: str) -> bytes:
+    """
+    Decode a base64 data: URI, as saved by the CAPTCHA saver script, into the bytes of the file it holds.
+    """
+    # Slice off the prefix once, rather than splitting the (large) string into a list first.
+    return base64.b64decode(uri[uri.index(',') + 1:])
 
-def strip_data_prefix(uri: str) -> str:
-    return uri.split(',', 1)[1]
+def decode_data_uri(uri: str) -> Image:
+    """
+    Decode a base64 data: URI, as saved by the CAPTCHA saver script, into an RGBA image.
+    """
+    return Image.open(io.BytesIO(decode_data_uri_bytes(uri))).convert('RGBA')
 
 def decode_captcha_json(data: dict) -> (Image, str):
     """
     @param data Dict of decoded JSON data from the CAPTCHA saver script.
     @return tuple of (aligned image, solution text)
     """
-    fg = Image.open(io.BytesIO(
-        base64.b64decode(
-            strip_data_prefix(data['fg'])
-        )
-    )).convert('RGBA')
+    fg = decode_data_uri(data['fg'])
 
     has_bg = data['bg'] is not None
 
     if has_bg: # Need to align the background
-        bg = Image.open(io.BytesIO(
-            base64.b64decode(
-                strip_data_prefix(data['bg'])
-            )
-        )).convert('RGBA')
+        bg = decode_data_uri(data['bg'])
 
         aligned = align_images(bg, fg)
     else:
@@ -40,17 +51,148 @@ def decode_captcha_json(data: dict) -> (Image, str):
 
     return aligned, data['sol']
 
-def decode_and_save(data: tuple):
-    aligned, sol = decode_captcha_json(data)
+def ingest_record(task: tuple[str, str, str]) -> tuple[Timings, str | None]:
+    """
+    Decode, align and save a single saver record. This runs in the worker processes.
+
+    @param task Tuple of (kind, payload, outdir). kind is 'path' if the payload is the path of a .json file,
+                or 'line' if the payload is the JSON text itself.
+    @return Tuple of (Timings of the stages, error message or None).
+    """
+    kind, payload, outdir = task
+    source = f"{payload}: " if kind == 'path' else ''
+    timings = Timings()
+
+    try:
+        if kind == 'path':
+            with timings.stage('read'):
+                with open(payload, 'rb') as fp:
+                    payload = fp.read()
+
+        with timings.stage('parse'):
+            data = json.loads(payload)
+
+        with timings.stage('decode'):
+            fg = decode_data_uri(data['fg'])
+            bg = decode_data_uri(data['bg']) if data['bg'] is not None else None
+
+        if bg is not None:
+            with timings.stage('align_images'):
+                aligned = align_images(bg, fg)
+        else:
+            aligned = fg
+
+        with timings.stage('save'):
+            aligned.save(os.path.join(outdir, data['sol'] + '.png'))
+    except Exception as e:
+        return timings, source + str(e)
+
+    return timings, None
+
+def iter_tasks(inputs: list[str], outdir: str) -> Iterator[tuple[str, str, str]]:
+    """
+    Lazily yield ingest_record() tasks for all of the given inputs.
+
+    @param inputs List of directories, .json files, .jsonl files, or - for JSONL on stdin.
+    @param outdir Directory to save the images in.
+    """
+    for source in inputs:
+        if source == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield 'line', line, outdir
+        elif os.path.isdir(source):
+            with os.scandir(source) as it:
+                for entry in it:
+                    if entry.name.endswith('.json'):
+                        yield 'path', entry.path, outdir
+        elif source.endswith('.jsonl'):
+            with open(source, 'r') as fp:
+                for line in fp:
+                    if line.strip():
+                        yield 'line', line, outdir
+        else:
+            yield 'path', source, outdir
+
+def run_ingest(tasks: Iterator[tuple[str, str, str]], workers: int, max_pending: int, timings: Timings) \
+        -> tuple[int, int]:
+    """
+    Run ingest_record() over the tasks on a process pool.
+    At most max_pending tasks are in flight at once, so memory stays bounded no matter how large the input is.
+
+    @param timings Timings to merge the stage timings of every record into.
+    @return Tuple of (saved count, failed count).
+    """
+    saved = 0
+    failed = 0
+
+    def collect(result: tuple[Timings, str | None]):
+        nonlocal saved, failed
+        record_timings, error = result
+        timings.merge(record_timings)
+
+        if error is None:
+            saved += 1
+            timings.count('saved')
+        else:
+            failed += 1
+            timings.count('failed')
+            print(error)
+
+    if workers <= 1:
+        for task in tasks:
+            collect(ingest_record(task))
+
+        return saved, failed
+
+    with ProcessPoolExecutor(max_workers=workers) as exe:
+        pending = set()
+        for task in tasks:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+
+            pending.add(exe.submit(ingest_record, task))
+
+        for future in wait(pending).done:
+            collect(future.result())
+
+    return saved, failed
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Decodes CAPTCHA saver records into aligned images named with their solutions.'
+    )
+    parser.add_argument('inputs', action='store', nargs='+',
+                        help='Directories of .json files, .json files, .jsonl files, or - to read JSONL from stdin.')
+    parser.add_argument('-o', '--out', action='store', default='captchas',
+                        help='The directory to store images in. Defaults to captchas.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=os.cpu_count(),
+                        help='How many worker processes to use. Defaults to the number of CPUs.')
+    parser.add_argument('--max-pending', action='store', type=int, default=None,
+                        help='How many records may be in flight at once. Defaults to 4 per worker.')
+
+    args = parser.parse_args(argv[1:])
+
+    os.makedirs(args.out, exist_ok=True)
+
+    max_pending = args.max_pending or args.workers * 4
+
+    # The per-stage timings are printed at exit, so an interrupted run still shows them.
+    timings = Timings()
+    timings.report_at_exit()
+
+    start = time.perf_counter()
+    saved, failed = run_ingest(iter_tasks(args.inputs, args.out), args.workers, max_pending, timings)
+    elapsed = time.perf_counter() - start
 
-    outpath = os.path.join('captchas', sol + '.png')
-    aligned.save(outpath)
+    total = saved + failed
+    print(f"Saved {saved}, failed {failed} records in {elapsed:.1f}s "
+          f"({total / elapsed if elapsed > 0 else 0:.1f} records/s)")
 
+    return 0
 
 if __name__ == '__main__':
-    # for file in os.listdir('jsons/'):
-    #     with open(os.path.join('jsons', file), 'r') as fp:
-    #         data = json.load(fp)
-    #         decode_captcha_json(data)
-    with open(sys.argv[1], 'r') as fp:
-        decode_and_save(json.load(fp))
\ No newline at end of file
+    sys.exit(main(sys.argv))
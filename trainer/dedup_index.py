@@ -0,0 +1,275 @@
+"""
+Script to find duplicate CAPTCHA images across datasets, with a persistent index of image hashes.
+
+Every image is thresholded the way the model sees it, and hashed twice: an exact hash of the thresholded pixels, and
+a perceptual difference hash (dHash) that stays close for near-identical images, like the same CAPTCHA saved twice
+with a few pixels of difference. Two images with the same solution are duplicates if their exact hashes are equal, or
+their perceptual hashes differ in at most --distance bits. The first path in sorted order is kept.
+
+The hashes are kept in an index file (one JSON object per line) along with each file's size and modification time,
+so a later run only hashes the new or changed images. main.py --dedup-index uses the same index to drop the
+duplicates before training.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from PIL import Image
+from common_lite import get_file_label, walk_png_files
+from timing import Timings
+
+# The perceptual hash compares every cell of a 17x16 grid with its right neighbor, for 256 bits.
+HASH_SIZE = 16
+
+def threshold_image(img: Image) -> np.ndarray:
+    """
+    Threshold an image to pure black/white, the way common.encode_image() does for the model.
+    @param img PIL.Image of the CAPTCHA.
+    @return (80, 300) bool array, True for white.
+    """
+    pixels = np.asarray(img.convert('RGB').resize((300, 80), Image.BILINEAR), dtype=np.float32)
+    gray = pixels @ np.array([0.2989, 0.5870, 0.1140], dtype=np.float32)
+
+    return gray > 127
+
+def hash_image(path: str, timings: Timings = None) -> (str, str):
+    """
+    Compute the exact and perceptual hashes of an image.
+    @param path Path of the image.
+    @param timings Timings to record the stages in.
+    @return Tuple of (exact hash, perceptual hash), as hex strings.
+    """
+    timings = timings or Timings()
+
+    with timings.stage('imread'):
+        img = Image.open(path)
+        img.load()
+
+    with timings.stage('threshold'):
+        bits = threshold_image(img)
+
+    with timings.stage('hash'):
+        exact = hashlib.sha1(np.packbits(bits).tobytes()).hexdigest()
+
+        small = np.asarray(Image.fromarray(bits.astype(np.uint8) * 255)
+                           .resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX), dtype=np.int16)
+        perceptual = np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+    return exact, perceptual
+
+def _hash_entry(args: tuple[str, int, int]) -> tuple[dict | None, str | None, Timings]:
+    """
+    Pool worker wrapper around hash_image(), that builds the index entry of an image.
+    @param args Tuple of (path, size, mtime_ns) of the image.
+    @return Tuple of (index entry or None, error message or None, Timings of the stages).
+    """
+    path, size, mtime_ns = args
+    timings = Timings()
+
+    try:
+        exact, perceptual = hash_image(path, timings)
+    except Exception as e:
+        return None, f"{path}: {e}", timings
+
+    entry = {'path': path, 'size': size, 'mtime_ns': mtime_ns, 'label': get_file_label(path),
+             'exact': exact, 'perceptual': perceptual}
+
+    return entry, None, timings
+
+def load_index(path: str) -> dict[str, dict]:
+    """
+    Load the hash index written by save_index().
+    @param path Path of the index, a file with one JSON object per line.
+    @return Dict of image path to its index entry.
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+
+    with open(path, 'r') as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Probably a line cut short by an interrupted run.
+                continue
+
+            entries[entry['path']] = entry
+
+    return entries
+
+def save_index(path: str, entries: dict[str, dict]):
+    """
+    Save the hash index, replacing the old one only once the new one is completely written.
+    @param path Path of the index.
+    @param entries Dict of image path to its index entry.
+    """
+    with open(f"{path}.tmp", 'w') as fp:
+        for image_path in sorted(entries):
+            fp.write(json.dumps(entries[image_path]) + '\n')
+
+    os.replace(f"{path}.tmp", path)
+
+def update_index(index_path: str, paths: list[str], workers: int = None, chunk_size=64,
+                 timings: Timings = None) -> (dict[str, dict], int, int):
+    """
+    Bring the hash index up to date with the given images, hashing only the ones that are new or changed.
+    Entries of images that no longer exist are dropped, entries of other existing images are kept.
+
+    @param index_path Path of the index. It is created if it doesn't exist yet.
+    @param paths The list of image paths to index.
+    @param workers Number of worker processes. Defaults to the number of CPUs.
+    @param chunk_size Number of images handed to a worker at a time.
+    @param timings Timings to merge the stage timings of every image into.
+    @return Tuple of (dict of image path to index entry for the given paths, hashed count, failed count).
+    """
+    entries = {path: entry for path, entry in load_index(index_path).items() if os.path.exists(path)}
+
+    current = {}
+    pending = []
+    for path in paths:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        entry = entries.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            current[path] = entry
+        else:
+            pending.append((path, stat.st_size, stat.st_mtime_ns))
+
+    failed = 0
+    if pending:
+        # Forking a process that has TF's threads running can deadlock the children, so they start fresh.
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            for entry, error, image_timings in pool.imap_unordered(_hash_entry, pending, chunksize=chunk_size):
+                if timings is not None:
+                    timings.merge(image_timings)
+
+                if error is not None:
+                    failed += 1
+                    print(error)
+                    continue
+
+                entries[entry['path']] = current[entry['path']] = entry
+
+    save_index(index_path, entries)
+
+    return current, len(pending) - failed, failed
+
+def hamming_distance(a: str, b: str) -> int:
+    """ Get the number of bits that differ between two hex hashes. """
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+def find_duplicates(entries: list[dict], distance=8) -> (dict[str, tuple[str, str]], list[tuple[str, str]]):
+    """
+    Find the duplicate images among the given index entries.
+    Only images with the same solution are compared, so two different CAPTCHAs that happen to look alike are kept.
+
+    @param entries The index entries of the images.
+    @param distance How many bits the perceptual hashes of near-duplicates may differ in. 0 only finds exact ones.
+    @return Tuple of (dict of duplicate path to (kept path, 'exact' or 'near'), list of (path, path) pairs of
+            identical images with different solutions, one of which is probably mislabeled).
+    """
+    by_label = {}
+    for entry in sorted(entries, key=lambda entry: entry['path']):
+        by_label.setdefault(entry['label'], []).append(entry)
+
+    duplicates = {}
+    for group in by_label.values():
+        kept = []
+        for entry in group:
+            for other in kept:
+                if entry['exact'] == other['exact']:
+                    duplicates[entry['path']] = (other['path'], 'exact')
+                    break
+                if distance > 0 and hamming_distance(entry['perceptual'], other['perceptual']) <= distance:
+                    duplicates[entry['path']] = (other['path'], 'near')
+                    break
+            else:
+                kept.append(entry)
+
+    first_by_exact = {}
+    conflicts = []
+    for entry in sorted(entries, key=lambda entry: entry['path']):
+        other = first_by_exact.setdefault(entry['exact'], entry)
+        if other['label'] != entry['label']:
+            conflicts.append((other['path'], entry['path']))
+
+    return duplicates, conflicts
+
+def dedup_paths(paths: list[str], index_path: str, distance=8, workers: int = None) -> list[str]:
+    """
+    Drop the duplicate images from a list of image paths, updating the hash index on the way.
+    @param paths The list of image paths, named {sol}.png.
+    @param index_path Path of the index.
+    @param distance How many bits the perceptual hashes of near-duplicates may differ in.
+    @param workers Number of worker processes to hash new images with.
+    @return The paths that aren't duplicates, in their original order. Images that can't be read are kept,
+            so they fail loudly later rather than disappear.
+    """
+    entries, hashed, _ = update_index(index_path, paths, workers)
+    duplicates, _ = find_duplicates(list(entries.values()), distance)
+
+    kept = [path for path in paths if os.path.abspath(path) not in duplicates]
+    print(f"Hashed {hashed} new images, dropped {len(paths) - len(kept)} duplicates of {len(paths)} images.")
+
+    return kept
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Indexes the hashes of the images in the given datasets, and reports the duplicates.'
+    )
+    parser.add_argument('-d', '--dataset', action='append', required=True,
+                        help='Add a directory of images named {sol}.png to the index.')
+    parser.add_argument('-i', '--index', action='store', required=True,
+                        help='The index file. It is created if it doesn\'t exist, and only new or changed images '
+                             'are hashed otherwise.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=os.cpu_count(),
+                        help='How many worker processes to use. Defaults to the number of CPUs.')
+    parser.add_argument('--distance', action='store', type=int, default=8,
+                        help='How many of the 256 perceptual hash bits near-duplicates may differ in. '
+                             '0 only finds exact duplicates. Defaults to 8.')
+    parser.add_argument('-o', '--out', action='store', default=None,
+                        help='Write the duplicates to this CSV file, with the image each is a duplicate of.')
+
+    args = parser.parse_args(argv[1:])
+
+    # The per-stage timings are printed at exit, so an interrupted run still shows them.
+    timings = Timings()
+    timings.report_at_exit()
+
+    paths = []
+    for root in args.dataset:
+        paths.extend(walk_png_files(root))
+
+    start = time.perf_counter()
+    entries, hashed, failed = update_index(args.index, paths, args.workers, timings=timings)
+    elapsed = time.perf_counter() - start
+    print(f"Hashed {hashed} new or changed images, {failed} failed, {len(entries) - hashed} were already indexed "
+          f"({elapsed:.1f}s)")
+
+    duplicates, conflicts = find_duplicates(list(entries.values()), args.distance)
+    exact = sum(1 for _, kind in duplicates.values() if kind == 'exact')
+    print(f"Found {exact} exact and {len(duplicates) - exact} near duplicates among {len(entries)} images.")
+
+    for first, second in conflicts:
+        print(f"Identical images with different solutions: {first} {second}")
+
+    if args.out is not None:
+        with open(args.out, 'w', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['path', 'duplicate_of', 'kind'])
+            writer.writerows((path, kept, kind) for path, (kept, kind) in sorted(duplicates.items()))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
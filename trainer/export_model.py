@@ -0,0 +1,278 @@
+"""
+Script to export a trained model in smaller variants, and check what each of them costs.
+
+It can write TFLite models (float32, float16, or int8 dynamic range quantized) and TFJS layers models
+(float32, or float16/uint8 quantized weights, converted with tensorflowjs_converter like export_model.sh does).
+For every variant it reports the file size, the CPU latency of solving one CAPTCHA, and the accuracy on a held-out
+set of images named with their solutions, next to the original Keras model, so the smallest variant that is still
+accurate enough can be picked.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shlex
+import shutil
+import argparse
+import subprocess
+import tempfile
+
+from typing import Callable
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+
+from common import ctc_loss, ctc_loss_xla, ctc_decode_predictions, get_file_label, walk_png_files
+from infer import edit_distance
+from main import batch_dataset, encode_paths
+
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    # tf.lite.Interpreter is deprecated in favor of the ai_edge_litert package, but still works.
+    Interpreter = tf.lite.Interpreter
+
+TFLITE_VARIANTS = ['tflite-float32', 'tflite-float16', 'tflite-int8']
+TFJS_VARIANTS = ['tfjs-float32', 'tfjs-float16', 'tfjs-uint8']
+VARIANTS = TFLITE_VARIANTS + TFJS_VARIANTS
+
+CUSTOM_OBJECTS = {'ctc_loss': ctc_loss, 'ctc_loss_xla': ctc_loss_xla}
+
+def load_samples(paths: list[str], limit: int = None) -> (np.ndarray, list[str]):
+    """
+    Load encoded images and their solutions for scoring the variants.
+    @param paths The list of image paths, named {sol}.png.
+    @param limit Only load this many images.
+    @return Tuple of ((count, 300, 80, 1) float32 array of images, list of solutions).
+    """
+    paths = paths[:limit] if limit else paths
+    images = np.concatenate([X for X, _ in batch_dataset(encode_paths(paths, shuffle=False), 256)
+                             .as_numpy_iterator()])
+
+    return images, [get_file_label(path) for path in paths]
+
+def score(predict: Callable[[np.ndarray], np.ndarray], images: np.ndarray, labels: list[str]) -> dict:
+    """
+    Score a model on encoded images.
+    @param predict Function that takes a batch of images and returns the model's predictions for them.
+    @return Dict of the accuracy and character error rate.
+    """
+    predictions = []
+    for i in range(0, len(images), 64):
+        predictions.extend(ctc_decode_predictions(predict(images[i:i + 64])))
+
+    correct = sum(1 for label, prediction in zip(labels, predictions) if label == prediction)
+    errors = sum(edit_distance(label, prediction) for label, prediction in zip(labels, predictions))
+
+    return {
+        'accuracy': correct / len(labels),
+        'cer': errors / sum(len(label) for label in labels),
+    }
+
+def measure_latency(predict: Callable[[np.ndarray], np.ndarray], image: np.ndarray, repeats=50) -> float:
+    """
+    Measure the median latency of predicting a single image.
+    @return The latency in milliseconds.
+    """
+    batch = image[np.newaxis]
+    predict(batch)
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(batch)
+        latencies.append(time.perf_counter() - start)
+
+    return float(np.median(latencies) * 1000)
+
+def export_tflite(saved_model: str, path: str, quantization: str) -> int:
+    """
+    Convert a model exported as a SavedModel into a TFLite model.
+    @param saved_model Path of the SavedModel, exported with a fixed batch size so the LSTMs can be converted.
+    @param path Path of the .tflite file to write.
+    @param quantization 'float32' for none, 'float16', or 'int8' for int8 weights with dynamic range quantization.
+    @return The size of the file in bytes.
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model)
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+
+    with open(path, 'wb') as fp:
+        fp.write(converter.convert())
+
+    return os.path.getsize(path)
+
+def tflite_predictor(path: str) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Load a TFLite model exported by export_tflite() into a function that predicts a batch of images.
+    The model takes one image at a time, so the batch is run through it image by image.
+    """
+    interpreter = Interpreter(model_path=path)
+    interpreter.allocate_tensors()
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+
+    def predict(images: np.ndarray) -> np.ndarray:
+        predictions = []
+        for image in images:
+            interpreter.set_tensor(input_index, image[np.newaxis])
+            interpreter.invoke()
+            predictions.append(interpreter.get_tensor(output_index)[0])
+
+        return np.stack(predictions)
+
+    return predict
+
+def export_tfjs(converter: list[str], h5_path: str, outdir: str, quantization: str) -> int:
+    """
+    Convert a Keras model into a TFJS layers model, with the weights in one shard, plus the weights.json
+    that the user script imports, like export_model.sh does.
+    @param converter The tensorflowjs_converter command.
+    @param h5_path Path of the Keras model, in the .h5 format main.py saves.
+    @param outdir Directory to write the TFJS model in.
+    @param quantization 'float32' for none, 'float16', or 'uint8'.
+    @return The size of the model.json and weights in bytes.
+    """
+    args = ['--weight_shard_size_bytes=104857600', '--input_format=keras', '--output_format=tfjs_layers_model']
+    if quantization != 'float32':
+        args.append(f"--quantize_{quantization}=*")
+
+    subprocess.run(converter + args + [h5_path, outdir], check=True)
+
+    with open(os.path.join(outdir, 'group1-shard1of1.bin'), 'rb') as fp:
+        weights = fp.read()
+    with open(os.path.join(outdir, 'weights.json'), 'w') as fp:
+        json.dump({'weights': base64.b64encode(weights).decode('ascii')}, fp)
+
+    return os.path.getsize(os.path.join(outdir, 'model.json')) + len(weights)
+
+def quantize_weights(model: keras.Model, quantization: str) -> keras.Model:
+    """
+    Get a copy of a model with its weights rounded the way TFJS quantizes them, to score a TFJS variant in Python.
+    TFJS stores the quantized weights, but computes with them in float32 again after loading.
+    @param quantization 'float32' for none, 'float16', or 'uint8' for affine quantization of every weight tensor.
+    """
+    weights = []
+    for w in model.get_weights():
+        if quantization == 'float16':
+            w = w.astype(np.float16).astype(np.float32)
+        elif quantization == 'uint8':
+            low, high = float(w.min()), float(w.max())
+            scale = (high - low) / 255 or 1.0
+            w = (np.round((w - low) / scale) * scale + low).astype(np.float32)
+
+        weights.append(w)
+
+    # Cloning compiles the copy like the original, so it needs to find the loss.
+    with keras.utils.custom_object_scope(CUSTOM_OBJECTS):
+        copy = keras.models.clone_model(model)
+    copy.set_weights(weights)
+
+    return copy
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Exports a trained model in smaller variants, and reports their size, latency and accuracy.'
+    )
+    parser.add_argument('-m', '--model', action='store', required=True,
+                        help='The trained model, as saved by main.py.')
+    parser.add_argument('-d', '--dataset', action='append', required=True,
+                        help='Add a directory of held-out images named {sol}.png to score the variants on.')
+    parser.add_argument('-o', '--out', action='store', default=None,
+                        help='The directory to write the variants in. Defaults to the model path without extension.')
+    parser.add_argument('-v', '--variant', action='append', choices=VARIANTS, default=None,
+                        help='Export this variant. Can be given more than once. Defaults to all of them.')
+    parser.add_argument('-l', '--limit', action='store', type=int, default=1000,
+                        help='Only score the variants on this many images. Defaults to 1000.')
+    parser.add_argument('-t', '--tolerance', action='store', type=float, default=0.01,
+                        help='How much accuracy a variant may lose compared to the Keras model to be recommended. '
+                             'Defaults to 0.01.')
+    parser.add_argument('--tfjs-converter', action='store', default='tensorflowjs_converter',
+                        help='The tensorflowjs_converter command, e.g. "pyenv exec tensorflowjs_converter". '
+                             'The TFJS variants are skipped if it can\'t be found.')
+
+    args = parser.parse_args(argv[1:])
+
+    outdir = args.out or os.path.splitext(args.model)[0]
+    os.makedirs(outdir, exist_ok=True)
+
+    variants = args.variant or VARIANTS
+    converter = shlex.split(args.tfjs_converter)
+    if any(variant in TFJS_VARIANTS for variant in variants) and shutil.which(converter[0]) is None:
+        print(f"{converter[0]} not found, skipping the TFJS variants.")
+        variants = [variant for variant in variants if variant not in TFJS_VARIANTS]
+
+    model = keras.models.load_model(args.model, custom_objects=CUSTOM_OBJECTS)
+
+    paths = []
+    for root in args.dataset:
+        paths.extend(walk_png_files(root))
+
+    images, labels = load_samples(sorted(paths), args.limit)
+    print(f"Scoring on {len(images)} images.")
+
+    def keras_predict(model: keras.Model) -> Callable[[np.ndarray], np.ndarray]:
+        return lambda batch: model.predict_on_batch(batch)
+
+    report = [{
+        'variant': 'keras',
+        'path': args.model,
+        'size': os.path.getsize(args.model),
+        'latency_ms': measure_latency(keras_predict(model), images[0]),
+        **score(keras_predict(model), images, labels),
+    }]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        saved_model = os.path.join(tmp, 'saved_model')
+        if any(variant in TFLITE_VARIANTS for variant in variants):
+            # The LSTMs only convert to TFLite with a fixed batch size.
+            model.export(saved_model, input_signature=[tf.TensorSpec((1, 300, 80, 1), tf.float32)], verbose=False)
+
+        for variant in variants:
+            kind, quantization = variant.split('-')
+
+            if kind == 'tflite':
+                path = os.path.join(outdir, f"model-{quantization}.tflite")
+                size = export_tflite(saved_model, path, quantization)
+                predict = tflite_predictor(path)
+                latency = measure_latency(predict, images[0])
+            else:
+                path = os.path.join(outdir, f"tfjs-{quantization}")
+                size = export_tfjs(converter, args.model, path, quantization)
+                predict = keras_predict(quantize_weights(model, quantization))
+                # TFJS runs in the browser, its latency can't be measured from here.
+                latency = None
+
+            report.append({
+                'variant': variant,
+                'path': path,
+                'size': size,
+                'latency_ms': latency,
+                **score(predict, images, labels),
+            })
+
+    baseline = report[0]['accuracy']
+    print(f"{'variant':<16}{'size (KB)':>12}{'latency (ms)':>14}{'accuracy':>10}{'change':>10}{'CER':>10}")
+    for entry in report:
+        latency = f"{entry['latency_ms']:.2f}" if entry['latency_ms'] is not None else '-'
+        print(f"{entry['variant']:<16}{entry['size'] / 1024:>12.1f}{latency:>14}{entry['accuracy']:>10.4f}"
+              f"{entry['accuracy'] - baseline:>+10.4f}{entry['cer']:>10.4f}")
+
+    acceptable = [entry for entry in report if entry['accuracy'] >= baseline - args.tolerance]
+    smallest = min(acceptable, key=lambda entry: entry['size'])
+    print(f"Smallest variant within {args.tolerance} accuracy of the Keras model: {smallest['variant']} "
+          f"({smallest['path']})")
+
+    with open(os.path.join(outdir, 'report.json'), 'w') as fp:
+        json.dump({'images': len(images), 'tolerance': args.tolerance, 'recommended': smallest['variant'],
+                   'variants': report}, fp, indent=2)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
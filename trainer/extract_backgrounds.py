@@ -0,0 +1,136 @@
+"""
+Script to extract a bank of CAPTCHA backgrounds ahead of time, for use by synthesize.py.
+
+Every source image is run through isolate_background() several times. It removes a random selection
+of the noise each time, so every variant is a little different. The results are stored in a single
+(count, 80, 300) uint8 .npy array, which synthesize.py memory-maps and samples from.
+"""
+import os
+import time
+import random
+import argparse
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from common_lite import walk_png_files
+from synthesize import isolate_background
+from timing import Timings
+
+def extract_variants(task: tuple[str, int, int]) -> tuple[np.ndarray | None, Timings]:
+    """
+    Extract background variants from a single source image. This runs in the worker processes.
+
+    @param task Tuple of (source image path, number of variants, seed).
+    @return Tuple of ((variants, 80, 300) uint8 array of backgrounds, or None if the image couldn't be read,
+            Timings of the stages).
+    """
+    path, variants, seed = task
+    timings = Timings()
+
+    with timings.stage('imread'):
+        img = cv2.imread(path)
+    if img is None:
+        return None, timings
+
+    random.seed(seed)
+
+    backgrounds = []
+    for _ in range(variants):
+        with timings.stage('isolate_background'):
+            # isolate_background() gives a 3-channel grayscale image, one channel is all we need to keep.
+            backgrounds.append(isolate_background(img)[..., 0])
+
+    return np.stack(backgrounds), timings
+
+def extract_backgrounds(paths: list[str], bank_path: str, variants: int, seed: int, workers: int,
+                        timings: Timings = None, chunk_size=4096) -> int:
+    """
+    Extract a background bank from the given source images.
+
+    @param paths List of source image paths.
+    @param bank_path Path of the .npy file to write.
+    @param variants Number of variants to extract per source image.
+    @param seed Seed for the random noise removal.
+    @param workers Number of worker processes.
+    @param timings Timings to merge the stage timings of every source image into.
+    @param chunk_size How many backgrounds to copy at a time, when some sources are skipped.
+    @return The number of backgrounds in the bank.
+    """
+    rng = random.Random(seed)
+    tasks = [(path, variants, rng.getrandbits(64)) for path in paths]
+
+    # Written through a memory map, so the bank never has to fit in memory.
+    tmp_path = bank_path + '.tmp.npy'
+    bank = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths) * variants, 80, 300))
+    count = 0
+
+    with multiprocessing.Pool(workers) as pool:
+        for path, (backgrounds, image_timings) in zip(paths, pool.imap(extract_variants, tasks, chunksize=8)):
+            if timings is not None:
+                timings.merge(image_timings)
+
+            if backgrounds is None:
+                print(f"Could not read {path}, skipping it.")
+                continue
+
+            bank[count:count + len(backgrounds)] = backgrounds
+            count += len(backgrounds)
+
+    if count == len(bank):
+        bank.flush()
+        del bank
+        os.replace(tmp_path, bank_path)
+    else:
+        # Some sources were skipped, so only the front of the bank is filled. It is copied to a bank of the right
+        # size a chunk at a time, so it never has to fit in memory here either.
+        trimmed_path = bank_path + '.trimmed.tmp.npy'
+        trimmed = np.lib.format.open_memmap(trimmed_path, mode='w+', dtype=np.uint8, shape=(count, 80, 300))
+        for start in range(0, count, chunk_size):
+            end = min(start + chunk_size, count)
+            trimmed[start:end] = bank[start:end]
+
+        trimmed.flush()
+        del trimmed, bank
+        os.replace(trimmed_path, bank_path)
+        os.remove(tmp_path)
+
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='4chan-captcha-background-extractor'
+    )
+    parser.add_argument('-b', '--backgrounds', action='store', required=True,
+                        help='The root of the directory tree containing images to extract backgrounds from.')
+    parser.add_argument('-o', '--out', action='store', required=True,
+                        help='The .npy file to store the background bank in.')
+    parser.add_argument('-v', '--variants', action='store', type=int, default=4,
+                        help='How many randomized variants to extract from each image. Defaults to 4.')
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0,
+                        help='Seed for the random noise removal. Defaults to 0.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=os.cpu_count(),
+                        help='How many worker processes to use. Defaults to the number of CPUs.')
+
+    args = parser.parse_args()
+
+    paths = sorted(walk_png_files(args.backgrounds))
+
+    # np.save() would add the extension anyway, so keep the path the same either way.
+    out = args.out if args.out.endswith('.npy') else args.out + '.npy'
+
+    # The per-stage timings are printed at exit, so an interrupted run still shows them.
+    timings = Timings()
+    timings.report_at_exit()
+
+    start = time.perf_counter()
+    count = extract_backgrounds(paths, out, args.variants, args.seed, args.workers, timings)
+    elapsed = time.perf_counter() - start
+
+    print(f"Extracted {count} backgrounds from {len(paths)} images in {elapsed:.1f}s")
+    if count == 0:
+        print('The bank is empty, synthesize.py and main.py --synthetic-bank can\'t use it.')
+
+if __name__ == '__main__':
+    main()
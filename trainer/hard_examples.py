@@ -0,0 +1,107 @@
+"""
+A sampler that draws the training samples of every epoch with probabilities that favor the hard ones.
+
+main.py keeps a running estimate of the CTC loss of every training sample, by scoring a rotating part of them after
+each epoch. Each epoch then draws as many samples as there are, with replacement, with probabilities proportional to
+loss ** (1 / temperature). A mixing floor spreads part of the probability evenly, so the easy samples are still seen.
+"""
+from typing import Callable
+
+import numpy as np
+import tensorflow as tf
+
+class HardExampleSampler:
+    """ Running per-sample loss estimates, and the weighted draws of training samples based on them. """
+
+    def __init__(self, temperature=1.0, floor=0.2, smoothing=0.5, rescore_fraction=0.25, seed: int = None):
+        """
+        @param temperature How strongly to favor the hard samples. 1 draws samples in proportion to their loss,
+                           higher values flatten the distribution towards uniform, lower ones sharpen it.
+        @param floor What fraction of the draws to spread evenly over all samples, so none of them are dropped.
+        @param smoothing How much of a sample's previous loss estimate to keep when it is scored again.
+        @param rescore_fraction What fraction of the samples to score after every epoch.
+        @param seed Seed for the draws, or None for a random one.
+        """
+        if temperature <= 0:
+            raise ValueError(f"temperature ({temperature}) must be above 0")
+        if not 0 <= floor <= 1:
+            raise ValueError(f"floor ({floor}) must be between 0 and 1")
+
+        self.temperature = temperature
+        self.floor = floor
+        self.smoothing = smoothing
+        self.rescore_fraction = rescore_fraction
+        self.rng = np.random.default_rng(seed)
+
+        self.losses = np.zeros(0)
+        self.load: Callable[[np.ndarray], tf.data.Dataset] = None
+        self.rescore_order = np.zeros(0, dtype=np.int64)
+        self.rescore_position = 0
+
+    def attach(self, count: int, load: Callable[[np.ndarray], tf.data.Dataset]):
+        """
+        Attach the sampler to the training samples it draws from.
+        @param count How many training samples there are.
+        @param load Function that takes sorted sample indices, and returns a batched tf.data.Dataset of those
+                    samples, in the same order.
+        """
+        # NaN until a sample is scored for the first time.
+        self.losses = np.full(count, np.nan)
+        self.load = load
+        self.rescore_order = self.rng.permutation(count)
+        self.rescore_position = 0
+
+    def probabilities(self) -> np.ndarray:
+        """ Get the probability of drawing each sample. """
+        count = len(self.losses)
+        scored = ~np.isnan(self.losses)
+        if not scored.any():
+            return np.full(count, 1 / count)
+
+        # Samples that haven't been scored yet count as the hardest, so they get scored and seen soon.
+        losses = np.where(scored, self.losses, self.losses[scored].max())
+        # In log space, so a low temperature can't overflow the weights. The largest weight is scaled to 1.
+        log_weights = np.log(np.maximum(losses, 1e-6)) / self.temperature
+        weights = np.exp(log_weights - log_weights.max())
+
+        return self.floor / count + (1 - self.floor) * weights / weights.sum()
+
+    def draw(self) -> np.ndarray:
+        """ Draw the sample indices of one epoch. """
+        count = len(self.losses)
+        return self.rng.choice(count, count, replace=True, p=self.probabilities())
+
+    def indices_dataset(self) -> tf.data.Dataset:
+        """ Get an unbatched tf.data.Dataset of sample indices, with new draws every epoch. """
+        return tf.data.Dataset.from_generator(
+            lambda: iter(self.draw()), output_signature=tf.TensorSpec(shape=(), dtype=tf.int64)
+        )
+
+    def next_rescore_indices(self) -> np.ndarray:
+        """ Get the sorted indices of the next part of the samples to score, going through all of them in turn. """
+        count = len(self.losses)
+        size = max(int(count * self.rescore_fraction), 1)
+
+        indices = np.take(self.rescore_order, range(self.rescore_position, self.rescore_position + size), mode='wrap')
+        self.rescore_position = (self.rescore_position + size) % count
+
+        return np.unique(indices)
+
+    def update(self, indices: np.ndarray, losses: np.ndarray):
+        """
+        Update the loss estimates of the given samples with their latest losses.
+        @param indices The sample indices.
+        @param losses The CTC loss of each of those samples.
+        """
+        # A NaN or inf loss would make every draw probability NaN, so it counts as the hardest loss seen instead.
+        losses = np.asarray(losses, dtype=np.float64)
+        finite = np.isfinite(losses)
+        if not finite.all():
+            known = self.losses[~np.isnan(self.losses)]
+            hardest = max(losses[finite].max(initial=0), known.max(initial=0)) or 1.0
+            losses = np.where(finite, losses, hardest)
+
+        losses = np.maximum(losses, 0)
+        previous = self.losses[indices]
+        self.losses[indices] = np.where(np.isnan(previous), losses,
+                                        self.smoothing * previous + (1 - self.smoothing) * losses)
@@ -1,25 +1,114 @@
-""" Simple script that infers the CAPTCHA solution using the trained model.  """
+"""
+Simple script that infers the CAPTCHA solution using the trained model.
+
+Given a directory of images named with their solutions instead of a single image, it evaluates the model on them,
+in batches, and reports the accuracy, character error rate and speed.
+"""
+import os
+import csv
+import time
 import argparse
 import tensorflow as tf
 
-from common import ctc_loss, ctc_decode_predictions, encode_sample
+from common import ctc_loss, ctc_loss_xla, ctc_decode_predictions, encode_sample, get_file_label, walk_png_files
+from main import batch_dataset, encode_paths
+
+def edit_distance(a: str, b: str) -> int:
+    """ Get the Levenshtein distance between two strings. """
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+
+    return previous[-1]
+
+def evaluate(model: tf.keras.Model, paths: list[str], batch_size=64, beam_width: int = None) \
+        -> (list[tuple[str, str, str, int]], float):
+    """
+    Predict the solutions of the images at the given paths, streaming them through the training input pipeline.
+    @param model The trained model.
+    @param paths The list of image paths, named {sol}.png.
+    @param batch_size How many images to predict at once.
+    @param beam_width Decode with beam search of this width, instead of greedy search.
+    @return Tuple of (list of (path, label, prediction, edit distance) tuples, seconds taken).
+    """
+    labels = [get_file_label(path) for path in paths]
+    dataset = batch_dataset(encode_paths(paths, shuffle=False), batch_size)
+
+    predictions = []
+    start = time.perf_counter()
+    for X, _ in dataset:
+        predictions.extend(ctc_decode_predictions(model.predict_on_batch(X), beam_width))
+    elapsed = time.perf_counter() - start
+
+    results = [(path, label, prediction, edit_distance(label, prediction))
+               for path, label, prediction in zip(paths, labels, predictions)]
+
+    return results, elapsed
+
+def print_report(results: list[tuple[str, str, str, int]], elapsed: float):
+    """ Print the accuracy and character error rate of evaluate() results, overall and by CAPTCHA length. """
+    print(f"Evaluated {len(results)} images in {elapsed:.1f}s ({len(results) / elapsed if elapsed > 0 else 0:.1f} img/s)")
+
+    by_length = {}
+    for result in results:
+        by_length.setdefault(len(result[1]), []).append(result)
+
+    print(f"{'length':>8}{'images':>10}{'accuracy':>10}{'CER':>10}")
+    for length, group in sorted(by_length.items()) + [('all', results)]:
+        correct = sum(1 for _, label, prediction, _ in group if label == prediction)
+        chars = sum(len(label) for _, label, _, _ in group)
+        errors = sum(distance for _, _, _, distance in group)
+        print(f"{length:>8}{len(group):>10}{correct / len(group):>10.4f}{errors / chars if chars else 0:>10.4f}")
+
+def save_mistakes(path: str, results: list[tuple[str, str, str, int]]) -> int:
+    """
+    Save the wrong predictions from evaluate() results to a CSV file.
+    @return The number of mistakes.
+    """
+    mistakes = [result for result in results if result[3] > 0]
+
+    with open(path, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['path', 'label', 'prediction', 'edit_distance'])
+        writer.writerows(mistakes)
+
+    return len(mistakes)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         prog='4chan-captcha-inferer'
     )
     parser.add_argument('-m', '--model', action='store', required=True)
-    parser.add_argument('image', action='store')
+    parser.add_argument('-w', '--beam-width', action='store', type=int, default=None,
+                        help='Decode with beam search of this width, instead of greedy search.')
+    parser.add_argument('-b', '--batch-size', action='store', type=int, default=64,
+                        help='How many images to predict at once when evaluating a directory. Defaults to 64.')
+    parser.add_argument('--mistakes', action='store', default='mistakes.csv',
+                        help='The CSV file to write the wrong predictions to when evaluating a directory. '
+                             'Defaults to mistakes.csv.')
+    parser.add_argument('image', action='store',
+                        help='The image to solve, or a directory of images named {sol}.png to evaluate the model on.')
 
     args = parser.parse_args()
 
-    model = tf.keras.models.load_model(args.model, custom_objects={'ctc_loss': ctc_loss})
-    model.summary()
+    model = tf.keras.models.load_model(args.model, custom_objects={'ctc_loss': ctc_loss, 'ctc_loss_xla': ctc_loss_xla})
+
+    if os.path.isdir(args.image):
+        results, elapsed = evaluate(model, sorted(walk_png_files(args.image)), args.batch_size, args.beam_width)
+        print_report(results, elapsed)
+
+        mistakes = save_mistakes(args.mistakes, results)
+        print(f"Wrote {mistakes} mistakes to {args.mistakes}")
+    else:
+        model.summary()
 
-    pred = model.predict(tf.expand_dims(
-        encode_sample(args.image)[0], 0
-    ))
+        pred = model.predict(tf.expand_dims(
+            encode_sample(args.image)[0], 0
+        ))
 
-    decoded = ctc_decode_predictions(pred)
+        decoded = ctc_decode_predictions(pred, args.beam_width)
 
-    print(decoded[0])
+        print(decoded[0])
@@ -8,7 +8,7 @@ from pathlib import Path
 from anticaptchaofficial.imagecaptcha import imagecaptcha
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from common import CHARACTER_SET
+from common_lite import CHARACTER_SET
 
 CHARACTER_SET = CHARACTER_SET[1:] # Get rid of the blank/unknown token.
 
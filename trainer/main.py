@@ -2,8 +2,16 @@
 The main script that creates and trains the model based on the given training data.
 """
 import os
+import sys
 import glob
+import json
+import inspect
+import time
 import random
+import socket
+import subprocess
+import functools
+import itertools
 import argparse
 import datetime
 
@@ -15,149 +23,1126 @@ import tensorflow.keras as keras
 
 from tensorflow.keras import layers
 
-from common import ctc_loss, CHARACTER_SET, num_to_char, char_to_num, \
-                   ctc_decode_predictions, encode_sample, walk_png_files
+from common import ctc_loss, ctc_loss_xla, CHARACTER_SET, \
+                   ctc_batch_metrics, encode_sample, encode_image, encode_label, get_file_label, \
+                   split_paths, walk_png_files
+from synthesize import GlyphBank, LABELS_DIR, load_background_bank, iter_synthetic_captchas
+from pack_dataset import load_packed_dataset, packed_sample_count
+from align_tf import iter_saver_records, load_saver_records
+from dedup_index import dedup_paths
+from bitcache import BitCache, cache_fingerprint
+from hard_examples import HardExampleSampler
 
-# This was taken from https://keras.io/examples/audio/ctc_asr/
-class CallbackEval(keras.callbacks.Callback):
-    """Displays a batch of outputs after every epoch."""
+class CallbackMetrics(keras.callbacks.Callback):
+    """
+    Computes the sequence accuracy and character error rate on the validation set after every epoch,
+    and adds them to the logs as val_accuracy and val_cer, so they end up in the history.
+    """
+
+    def __init__(self, dataset: tf.data.Dataset, max_batches: int = None, strategy: tf.distribute.Strategy = None):
+        """
+        @param dataset Batched validation tf.data.Dataset.
+        @param max_batches Only score this many batches, to save time on large validation sets.
+        @param strategy The MultiWorkerMirroredStrategy of a distributed run, where the dataset is this worker's own
+                        part. The counts of all workers are then summed, so every worker logs the same metrics.
+        """
+        super().__init__()
+        self.dataset = dataset.take(max_batches) if max_batches else dataset
+        self.strategy = strategy
+
+    def on_epoch_end(self, epoch: int, logs=None):
+        correct = 0
+        errors = 0.0
+        chars = 0
+        total = 0
+
+        # Shows up as its own span in --profile traces.
+        with tf.profiler.experimental.Trace('CallbackMetrics'):
+            for X, y in self.dataset:
+                batch_correct, batch_errors, batch_chars = ctc_batch_metrics(y, self.model(X, training=False))
+                correct += int(batch_correct)
+                errors += float(batch_errors)
+                chars += int(batch_chars)
+                total += len(y)
+
+        if self.strategy is not None:
+            correct, errors, chars, total = self.sum_over_workers([correct, errors, chars, total])
+
+        # The progress bar prints these along with the rest of the epoch's logs.
+        if logs is not None:
+            logs['val_accuracy'] = correct / total if total else 0.0
+            logs['val_cer'] = errors / chars if chars else 0.0
+
+    def sum_over_workers(self, counts: list[float]) -> list[float]:
+        """ Sum counts over all workers of the strategy. Every worker has to call this. """
+        def replica_sum(values: tf.Tensor) -> tf.Tensor:
+            return tf.distribute.get_replica_context().all_reduce('SUM', values)
+
+        summed = self.strategy.run(replica_sum, args=(tf.constant(counts, tf.float64),))
+        return self.strategy.experimental_local_results(summed)[0].numpy().tolist()
+
+
+class CallbackThroughput(keras.callbacks.Callback):
+    """
+    Measures the training throughput of every epoch, and adds it to the logs as
+    samples_per_second and step_time_ms, so it ends up in the history.
+    """
+
+    def __init__(self, batch_size: int):
+        """
+        @param batch_size The training batch size, to count samples from steps.
+        """
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch: int, logs=None):
+        self.steps = 0
+        self.step_time = 0.0
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch: int, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch: int, logs=None):
+        self.steps += 1
+        self.step_time += time.perf_counter() - self.step_start
+
+    def on_epoch_end(self, epoch: int, logs=None):
+        # Only the training steps count, not the validation at the end of the epoch.
+        if logs is not None and self.steps:
+            logs['samples_per_second'] = self.steps * self.batch_size / self.step_time
+            logs['step_time_ms'] = self.step_time / self.steps * 1000
+
+
+class CallbackHardExamples(keras.callbacks.Callback):
+    """
+    Scores part of the training samples after every epoch, and updates the per-sample loss estimates of a
+    HardExampleSampler with them, so the next epochs draw more of the samples the model gets wrong.
+    """
+
+    def __init__(self, sampler: HardExampleSampler):
+        """
+        @param sampler The sampler the training dataset draws from, attached to the training samples.
+        """
+        super().__init__()
+        self.sampler = sampler
+
+    def on_epoch_end(self, epoch: int, logs=None):
+        indices = self.sampler.next_rescore_indices()
+        losses = []
 
-    def __init__(self, dataset):
+        with tf.profiler.experimental.Trace('CallbackHardExamples'):
+            for X, y in self.sampler.load(indices):
+                losses.append(tf.reshape(self.model.loss(y, self.model(X, training=False)), [-1]).numpy())
+
+        self.sampler.update(indices, np.concatenate(losses))
+
+
+class CallbackProfile(keras.callbacks.Callback):
+    """
+    Captures a profiler trace of a range of training steps, for TensorBoard's Profile tab.
+    The trace covers everything running in the process, so it shows the tf.data pipeline (PNG decoding and the
+    map stages) next to the model steps and the callbacks, and every step is marked so TensorBoard can split
+    its time into waiting for input and computing.
+    """
+
+    def __init__(self, log_dir: str, first: int, last: int):
+        """
+        @param log_dir Directory to save the trace in.
+        @param first The first training step to trace, counted over the whole run.
+        @param last The last training step to trace.
+        """
+        super().__init__()
+        self.log_dir = log_dir
+        self.first = first
+        self.last = last
+        self.step = 0
+        self.profiling = False
+        self.trace = None
+
+    def on_train_batch_begin(self, batch: int, logs=None):
+        if self.step == self.first:
+            tf.profiler.experimental.start(self.log_dir)
+            self.profiling = True
+
+        if self.profiling:
+            self.trace = tf.profiler.experimental.Trace('train', step_num=self.step, _r=1)
+            self.trace.__enter__()
+
+    def on_train_batch_end(self, batch: int, logs=None):
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+
+        if self.profiling and self.step == self.last:
+            self.stop()
+
+        self.step += 1
+
+    def on_train_end(self, logs=None):
+        # The run ended before the last step to trace.
+        if self.profiling:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.profiling = False
+        print(f"\nSaved the profiler trace in {self.log_dir}")
+
+
+class CallbackEarlyStopping(keras.callbacks.EarlyStopping):
+    """
+    Stops training once the validation loss hasn't improved for a number of epochs, and goes back to the weights of
+    the best epoch, like keras.callbacks.EarlyStopping. A resumed run starts from the state saved by
+    CallbackCheckpoint, so the best epoch and the epochs without improvement before the checkpoint still count.
+    """
+
+    def __init__(self, patience: int, best: float = None, best_epoch=0, best_weights: list[np.ndarray] = None,
+                 wait=0):
+        """
+        @param patience Stop once the validation loss hasn't improved for this many epochs.
+        @param best The best validation loss of the resumed run so far, or None for a new run.
+        @param best_epoch The (0-based) epoch of that loss.
+        @param best_weights The weights of the model after that epoch.
+        @param wait How many epochs the validation loss hadn't improved for at the checkpoint.
+        """
+        super().__init__(monitor='val_loss', patience=patience, restore_best_weights=True, verbose=1)
+        self.resume_state = (best, best_epoch, best_weights, wait)
+
+    def on_train_begin(self, logs=None):
+        super().on_train_begin(logs)
+
+        # Keras resets all of these when training begins, and has no argument to start from them.
+        best, best_epoch, best_weights, wait = self.resume_state
+        if best is not None:
+            self.best = best
+            self.best_epoch = best_epoch
+            self.best_weights = best_weights
+            self.wait = wait
+
+
+class CallbackCheckpoint(keras.callbacks.Callback):
+    """
+    Saves the model along with the optimizer state every few epochs, so the run can be resumed with --resume.
+    Checkpoints are named by the number of epochs done, and are written to a temporary file first,
+    so a crash while saving never leaves a broken checkpoint behind.
+    The weights of the epoch with the lowest validation loss are kept in best.npz, which is never pruned, and every
+    checkpoint has an epoch-*.json with the CallbackEarlyStopping state to resume with.
+    """
+
+    def __init__(self, directory: str, every=1, keep=2, best: float = None,
+                 early_stopping: CallbackEarlyStopping = None):
+        """
+        @param directory Directory to save the checkpoints in.
+        @param every Save a checkpoint every this many epochs.
+        @param keep How many of the latest checkpoints to keep.
+        @param best The lowest validation loss of the resumed run so far, or None for a new run.
+        @param early_stopping The early stopping callback whose state to save, if any. It has to come before this
+                              callback in the callback list, so it has seen the epoch already.
+        """
         super().__init__()
-        self.dataset = dataset
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.best = best
+        self.early_stopping = early_stopping
 
     def on_epoch_end(self, epoch: int, logs=None):
-        predictions = []
-        targets = []
-        for batch in self.dataset:
-            X, y = batch
-            batch_predictions = self.model.predict(X)
-            batch_predictions = ctc_decode_predictions(batch_predictions)
-            predictions.extend(batch_predictions)
-            for label in y:
-                label = tf.strings.reduce_join(num_to_char(label)) \
-                                  .numpy().decode("utf-8")
+        done = epoch + 1
+        os.makedirs(self.directory, exist_ok=True)
+
+        val_loss = (logs or {}).get('val_loss')
+        if val_loss is not None and (self.best is None or val_loss < self.best):
+            self.best = val_loss
+            save_best_weights(self.directory, self.model, done, val_loss)
+
+        if done % self.every != 0:
+            return
+
+        path = os.path.join(self.directory, f"epoch-{done:04d}.keras")
+        tmp_path = os.path.join(self.directory, f"epoch-{done:04d}.tmp.keras")
+        state_path = os.path.join(self.directory, f"epoch-{done:04d}.json")
+
+        # The state goes first, so every checkpoint has one.
+        with open(f"{state_path}.tmp", 'w') as fp:
+            json.dump({'wait': self.early_stopping.wait if self.early_stopping is not None else 0}, fp)
+        os.replace(f"{state_path}.tmp", state_path)
 
-                targets.append(label)
+        self.model.save(tmp_path)
+        os.replace(tmp_path, path)
 
-        for i in np.random.randint(0, len(predictions), 5):
-            print(f"Target    : {targets[i]}")
-            print(f"Prediction: {predictions[i]}")
-            print("-" * 100)
+        for _, old_path in list_checkpoints(self.directory)[:-self.keep]:
+            os.remove(old_path)
+            if os.path.exists(os.path.splitext(old_path)[0] + '.json'):
+                os.remove(os.path.splitext(old_path)[0] + '.json')
 
 
-def get_file_label(file: str) -> str:
-    label, _ = os.path.splitext(os.path.basename(file))
+def save_best_weights(directory: str, model: keras.Model, epochs: int, val_loss: float):
+    """
+    Save the weights of the best epoch so far to best.npz in a checkpoint directory, replacing the old ones.
+    Only the weights of the model are saved, so loading them never touches the optimizer state.
+    """
+    arrays = {f"weight_{i}": weight for i, weight in enumerate(model.get_weights())}
+    tmp_path = os.path.join(directory, 'best.tmp.npz')
+
+    np.savez(tmp_path, epochs=epochs, val_loss=val_loss, **arrays)
+    os.replace(tmp_path, os.path.join(directory, 'best.npz'))
+
+def load_checkpoint_state(directory: str, epochs: int) -> dict:
+    """
+    Load the early stopping state of a checkpoint saved by CallbackCheckpoint.
+    @param directory The checkpoint directory.
+    @param epochs The number of epochs done at the checkpoint.
+    @return Dict of CallbackEarlyStopping arguments (best, best_epoch, best_weights and wait), which is empty if
+            no epoch has been validated yet.
+    """
+    best_path = os.path.join(directory, 'best.npz')
+    if not os.path.exists(best_path):
+        return {}
+
+    wait = 0
+    state_path = os.path.join(directory, f"epoch-{epochs:04d}.json")
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as fp:
+            wait = json.load(fp)['wait']
+
+    with np.load(best_path) as best:
+        weights = [best[f"weight_{i}"] for i in range(len(best.files) - 2)]
 
-    return label.upper()
+        return {'best': float(best['val_loss']), 'best_epoch': int(best['epochs']) - 1, 'best_weights': weights,
+                'wait': wait}
+
+def list_checkpoints(directory: str) -> list[tuple[int, str]]:
+    """
+    List the checkpoints saved by CallbackCheckpoint in a directory.
+    @return List of (epochs done, path) tuples, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    checkpoints = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == '.keras' and stem.startswith('epoch-') and stem[6:].isdigit():
+            checkpoints.append((int(stem[6:]), os.path.join(directory, name)))
+
+    return sorted(checkpoints)
+
+def restore_checkpoint(model: keras.Model, path: str):
+    """
+    Restore the weights and the optimizer state of a model created by create_model() from a checkpoint.
+    """
+    # The optimizer only creates its variables on the first step, they have to exist to be restored into.
+    model.optimizer.build(model.trainable_variables)
+    model.load_weights(path)
 
-def create_model() -> keras.Model:
+def create_model(jit_compile=False, conv_filters=(32, 64, 128), dense_units=128, dropout=0.3,
+                 lstm_units=(128, 64)) -> keras.Model:
+    """
+    Create and compile the model.
+    Set a mixed precision policy with keras.mixed_precision.set_global_policy() before calling this to use it,
+    the output layer always stays float32 so the softmax and the CTC loss are numerically safe.
+    The defaults are the architecture found by experimentation, sweep.py tries others.
+    @param jit_compile Whether to compile the training and inference steps with XLA.
+    @param conv_filters The number of filters of each convolution, each followed by a 2x2 max pooling.
+    @param dense_units The size of the dense layer between the convolutions and the LSTMs.
+    @param dropout The dropout rate after the dense layer.
+    @param lstm_units The size of each bidirectional LSTM.
+    """
     image = keras.Input(shape=(300, 80, 1))
 
     x = image#layers.Dropout(0.2)(image)
-    x = layers.Conv2D(32, (3, 3), padding='same', activation='relu')(x)
-    x = layers.MaxPooling2D(padding='same', trainable=True)(x)
-    x = layers.Conv2D(64, (3, 3), padding='same', activation='relu')(x)
-    x = layers.MaxPooling2D(padding='same', trainable=True)(x)
-    x = layers.Conv2D(128, (3, 3), padding='same', activation='relu')(x)
-    x = layers.MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='same')(x)
-
-    x = layers.Reshape((-1, 1280))(x)
-
-    x = layers.Dense(128, activation='relu')(x)
-    x = layers.Dropout(0.3)(x) # 0.4 seems to train faster but make the model dumber, 0.3 works rather well
-    x = layers.Bidirectional(
-        layers.LSTM(128, return_sequences=True)
-    )(x)
-    x = layers.Bidirectional(
-        layers.LSTM(64, return_sequences=True)
-    )(x)
-
-    output = layers.Dense(len(CHARACTER_SET) + 1, activation='softmax')(x)
+    for filters in conv_filters:
+        x = layers.Conv2D(filters, (3, 3), padding='same', activation='relu')(x)
+        x = layers.MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='same')(x)
+
+    # One time step per remaining column, with the features of the whole column.
+    x = layers.Reshape((-1, x.shape[2] * x.shape[3]))(x)
+
+    x = layers.Dense(dense_units, activation='relu')(x)
+    x = layers.Dropout(dropout)(x) # 0.4 seems to train faster but make the model dumber, 0.3 works rather well
+    for units in lstm_units:
+        x = layers.Bidirectional(
+            layers.LSTM(units, return_sequences=True)
+        )(x)
+
+    output = layers.Dense(len(CHARACTER_SET) + 1, activation='softmax', dtype='float32')(x)
 
     model = keras.Model(image, output, name='4ChanCaptcha')
 
-    model.compile(optimizer='adam', loss=ctc_loss)
+    model.compile(optimizer='adam', loss=ctc_loss_xla if jit_compile else ctc_loss, jit_compile=jit_compile)
 
     return model
 
-def load_dataset(paths: list[str], batch_size=16) -> tf.data.Dataset:
+def load_synthetic_dataset(bank_path: str, labels_dir: str = LABELS_DIR, seed: int = None,
+                           parallelism: int = 4) -> tf.data.Dataset:
     """
-    Load a tf.data.Dataset of the encoded samples represented by the images at the given paths.
-    The images must be named {sol}.png, where sol is the solution to the CAPTCHA in that image.
-    @param paths The list of paths, one for each image.
+    Load an endless, unbatched tf.data.Dataset of synthetic CAPTCHAs, generated in memory as they are needed.
+    The samples are encoded the same way as encode_sample() encodes the images on disk.
+    @param bank_path Path of a background bank written by extract_backgrounds.py.
+    @param labels_dir Directory containing the character images.
+    @param seed Seed for the generated CAPTCHAs, or None for a random one.
+    @param parallelism How many generators to run side by side.
+    @return an encoded tf.data.Dataset of (image, label) samples.
+    """
+    glyphs = GlyphBank(labels_dir)
+    bank = load_background_bank(bank_path)
+
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    # Every generator gets a new seed, so every epoch sees fresh samples.
+    generator_seeds = itertools.count(seed * 1000)
+
+    def generate(_):
+        for img, label in iter_synthetic_captchas(glyphs, bank, next(generator_seeds)):
+            # OpenCV images are BGR, encode_image() wants RGB.
+            yield img[..., ::-1], label
+
+    def encode_synthetic(img: tf.Tensor, label: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+        return encode_image(img), encode_label(label)
+
+    signature = (
+        tf.TensorSpec(shape=(80, 300, 3), dtype=tf.uint8),
+        tf.TensorSpec(shape=(), dtype=tf.string),
+    )
+
+    dataset = tf.data.Dataset.range(parallelism).interleave(
+        lambda i: tf.data.Dataset.from_generator(generate, output_signature=signature, args=(i,)),
+        cycle_length=parallelism, num_parallel_calls=parallelism
+    )
+
+    return dataset.map(encode_synthetic, num_parallel_calls=tf.data.AUTOTUNE)
+
+def batch_dataset(dataset: tf.data.Dataset, batch_size=16, synthetic: tf.data.Dataset = None,
+                  synthetic_ratio=0.0) -> tf.data.Dataset:
+    """
+    Mix in synthetic samples if wanted, then batch and prefetch a dataset of encoded samples.
+    @param dataset Unbatched tf.data.Dataset of encoded samples.
     @param batch_size The batch size to use for the dataset.
-    @return an encoded and batched tf.data.Dataset.
+    @param synthetic Optional endless dataset of synthetic samples, from load_synthetic_dataset(), to mix in.
+    @param synthetic_ratio What fraction of the samples to draw from the synthetic dataset.
+                           The dataset still ends when the given dataset runs out.
+    @return a batched tf.data.Dataset.
     """
-    random.shuffle(paths)
+    if synthetic is not None and synthetic_ratio > 0:
+        dataset = tf.data.Dataset.sample_from_datasets(
+            [dataset, synthetic], weights=[1 - synthetic_ratio, synthetic_ratio],
+            stop_on_empty_dataset=True
+        )
 
+    return dataset.padded_batch(batch_size) \
+                  .prefetch(buffer_size=tf.data.AUTOTUNE)
+
+def encode_paths(paths: list[str], shuffle=True) -> tf.data.Dataset:
+    """
+    Load an unbatched tf.data.Dataset of the encoded samples represented by the images at the given paths.
+    The images must be named {sol}.png, where sol is the solution to the CAPTCHA in that image.
+    @param paths The list of paths, one for each image.
+    @param shuffle Whether to shuffle the samples, differently every epoch.
+    @return an encoded tf.data.Dataset of (image, label) samples.
+    """
     print('Have ' + str(len(paths)) + ' paths')
 
     dataset = tf.data.Dataset.from_tensor_slices(
         (paths, [get_file_label(path) for path in paths])
     )
 
-    return dataset.map(encode_sample, num_parallel_calls=tf.data.AUTOTUNE) \
-                  .padded_batch(batch_size) \
-                  .prefetch(buffer_size=tf.data.AUTOTUNE)
+    # Shuffling the paths is cheap, so the whole dataset fits in the shuffle buffer.
+    if shuffle:
+        dataset = dataset.shuffle(max(len(paths), 1), reshuffle_each_iteration=True)
+
+    return dataset.map(encode_sample, num_parallel_calls=tf.data.AUTOTUNE)
+
+def encode_sampled_paths(paths: list[str], sampler: HardExampleSampler, batch_size=16) -> tf.data.Dataset:
+    """
+    Load an unbatched tf.data.Dataset of encoded samples from the images at the given paths, drawn by a
+    HardExampleSampler every epoch instead of shuffled. The sampler is attached to the paths.
+    @param paths The list of paths, one for each image, named {sol}.png.
+    @param sampler The sampler to draw the samples with.
+    @param batch_size The batch size the sampler scores the samples in.
+    @return an encoded tf.data.Dataset of (image, label) samples.
+    """
+    print('Have ' + str(len(paths)) + ' paths')
+
+    paths_tensor = tf.constant(paths)
+    labels_tensor = tf.constant([get_file_label(path) for path in paths])
+
+    def encode_indices(indices: tf.data.Dataset) -> tf.data.Dataset:
+        return indices.map(lambda i: encode_sample(tf.gather(paths_tensor, i), tf.gather(labels_tensor, i)),
+                           num_parallel_calls=tf.data.AUTOTUNE)
+
+    sampler.attach(len(paths), lambda indices: batch_dataset(
+        encode_indices(tf.data.Dataset.from_tensor_slices(indices)), batch_size
+    ))
+
+    return encode_indices(sampler.indices_dataset())
+
+def cache_samples(dataset: tf.data.Dataset) -> tf.data.Dataset:
+    """
+    Cache a dataset of encoded samples in memory, the first time it's read through.
+    The images are only 0s and 1s, so they are cached as uint8 to take a quarter of the memory.
+    @param dataset Unbatched tf.data.Dataset of encoded samples, that is the same every time it's read.
+    @return the cached tf.data.Dataset.
+    """
+    return dataset.map(lambda image, label: (tf.cast(image, tf.uint8), label)) \
+                  .cache() \
+                  .map(lambda image, label: (tf.cast(image, tf.float32), label))
+
+def load_dataset(paths: list[str], batch_size=16, synthetic: tf.data.Dataset = None,
+                 synthetic_ratio=0.0) -> tf.data.Dataset:
+    """
+    Load a tf.data.Dataset of the encoded samples represented by the images at the given paths.
+    The images must be named {sol}.png, where sol is the solution to the CAPTCHA in that image.
+    @param paths The list of paths, one for each image.
+    @param batch_size The batch size to use for the dataset.
+    @param synthetic Optional synthetic dataset to mix in, see batch_dataset().
+    @param synthetic_ratio What fraction of the samples to draw from the synthetic dataset.
+    @return an encoded and batched tf.data.Dataset.
+    """
+    return batch_dataset(encode_paths(paths), batch_size, synthetic, synthetic_ratio)
 
-def load_and_segment_dataset(paths: list[str], train_fraction=0.9) -> (tf.data.Dataset, tf.data.Dataset):
+def load_and_segment_dataset(paths: list[str], train_fraction=0.9, synthetic: tf.data.Dataset = None,
+                             synthetic_ratio=0.0) -> (tf.data.Dataset, tf.data.Dataset):
     """
     Load two tf.data.Datasets of encoded samples, split into training and evaluation.
     @param paths The list of paths, one for each image.
     @param train_fraction What fraction of the data to use for training vs evaluation.
+    @param synthetic Optional synthetic dataset to mix into the training data, see batch_dataset().
+    @param synthetic_ratio What fraction of the training samples to draw from the synthetic dataset.
     @return Tuple of (training_dataset, evaluation_dataset).
     """
-    random.shuffle(paths)
-    split = int(len(paths) * train_fraction)
+    training_paths, validation_paths = split_paths(paths, train_fraction)
 
-    return load_dataset(paths[:split]), load_dataset(paths[split:])
+    return load_dataset(training_paths, synthetic=synthetic, synthetic_ratio=synthetic_ratio), \
+           batch_dataset(cache_samples(encode_paths(validation_paths, shuffle=False)))
 
-def train_model(model: keras.Model, dataset_paths: list[str], epochs=16):
-    """ Main routine that trains the model. """
-    training_dataset, validation_dataset = load_and_segment_dataset(
-        dataset_paths
-    )
+def load_packed_splits(roots: list[str], shard: tuple[int, int] = None) -> (tf.data.Dataset, tf.data.Dataset):
+    """
+    Load the unbatched training and evaluation tf.data.Datasets from datasets packed by pack_dataset.py.
+    @param roots The list of packed dataset directories.
+    @param shard Optional tuple of (count, index), to only load one worker's part, see load_packed_dataset().
+    @return Tuple of (training_dataset, evaluation_dataset).
+    """
+    def load_split(split: str, shuffle: bool) -> tf.data.Dataset:
+        datasets = [load_packed_dataset(root, split, shuffle, shard) for root in roots]
+        if len(datasets) == 1:
+            return datasets[0]
+
+        return tf.data.Dataset.sample_from_datasets(datasets) if shuffle \
+            else functools.reduce(tf.data.Dataset.concatenate, datasets)
+
+    return load_split('train', True), load_split('validation', False)
+
+def load_bit_cached_dataset(dataset: tf.data.Dataset, path: str = None, batch_size=16, shuffle=True,
+                            synthetic: tf.data.Dataset = None, synthetic_ratio=0.0,
+                            sampler: HardExampleSampler = None, fingerprint: str = None) -> tf.data.Dataset:
+    """
+    Cache a dataset of encoded samples in a BitCache, and load the batched tf.data.Dataset from the cache.
+    The given dataset is only read once, to build the cache.
+    @param dataset Unbatched tf.data.Dataset of encoded samples.
+    @param path Where to keep the cache, or None to keep it in RAM. An existing cache there is reused if it has the
+                same fingerprint.
+    @param batch_size The batch size to use for the dataset.
+    @param shuffle Whether to shuffle the samples every epoch.
+    @param synthetic Optional synthetic dataset to mix in. It is mixed in by whole batches, not by samples.
+    @param synthetic_ratio What fraction of the batches to draw from the synthetic dataset.
+    @param sampler Optional HardExampleSampler to draw the samples of every epoch with, instead of shuffling them.
+                   It is attached to the cached samples.
+    @param fingerprint The cache_fingerprint() of the samples' sources.
+    @return a batched tf.data.Dataset.
+    """
+    cache = BitCache.build(dataset, path, fingerprint=fingerprint)
+    print(f"Cached {len(cache)} samples in {cache.bits.nbytes / 2**20:.1f} MiB")
+
+    if sampler is not None:
+        sampler.attach(len(cache), lambda indices: cache.dataset(
+            batch_size, indices=tf.data.Dataset.from_tensor_slices(indices)
+        ))
+        dataset = cache.dataset(batch_size, indices=sampler.indices_dataset())
+    else:
+        dataset = cache.dataset(batch_size, shuffle)
+
+    if synthetic is not None and synthetic_ratio > 0:
+        dataset = tf.data.Dataset.sample_from_datasets(
+            [dataset, batch_dataset(synthetic, batch_size)], weights=[1 - synthetic_ratio, synthetic_ratio],
+            stop_on_empty_dataset=True
+        )
+
+    return dataset
+
+def save_split_manifest(path: str, training: list[str], validation: list[str], kind='images',
+                        records: list[str] = None):
+    """
+    Save the training/validation split of a training run, so it can be checked or reused later.
+    @param path Path of the JSON manifest.
+    @param training List of training sources, image paths or packed dataset directories.
+    @param validation List of validation sources.
+    @param kind What the sources are, 'images', 'packed' or 'records'. Only image splits can be trained on again.
+    @param records The saver records the run trained on as well, if any.
+    """
+    with open(path, 'w') as fp:
+        json.dump({'kind': kind, 'train': sorted(training), 'validation': sorted(validation),
+                   'records': sorted(records or [])}, fp, indent=1)
+
+def load_split_manifest(path: str) -> (list[str], list[str], list[str]):
+    """
+    Load a training/validation split of images saved by save_split_manifest().
+    @param path Path of the JSON manifest.
+    @return Tuple of (training_paths, validation_paths, saver records the run trained on as well).
+    """
+    with open(path, 'r') as fp:
+        manifest = json.load(fp)
+
+    # Manifests from before the kind was saved only listed images when they were reusable at all.
+    kind = manifest.get('kind', 'images')
+    if kind != 'images':
+        raise ValueError(f"{path} is the split of a run on {kind} datasets, not images, "
+                         f"pass them again with --{kind} instead")
+
+    return manifest['train'], manifest['validation'], manifest.get('records', [])
+
+def find_dataset_paths(roots: list[str], dedup_index: str = None) -> list[str]:
+    """
+    Find the images of the given dataset directories.
+    @param roots The dataset directories.
+    @param dedup_index Path of a dedup_index.py hash index to drop the duplicate images with, or None to keep them.
+    @return The list of image paths.
+    """
+    paths = []
+    for root in roots:
+        paths.extend(walk_png_files(root))
+
+    print(f"Found {len(paths)} image paths for training.")
+
+    if dedup_index is not None:
+        paths = dedup_paths(paths, dedup_index)
+
+    return paths
+
+def shard_paths(paths: list[str], count: int, index: int) -> list[str]:
+    """
+    Get one worker's part of the image paths, for a distributed run.
+    The paths are sorted first, so every worker agrees on the parts no matter what order they were found in.
+    @param paths The list of paths, one for each image.
+    @param count How many parts to split the paths into.
+    @param index Which part to get.
+    """
+    return sorted(paths)[index::count]
+
+def free_ports(count: int) -> list[int]:
+    """ Find a number of free local TCP ports, by letting the OS pick them. """
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for sock in sockets:
+            sock.bind(('localhost', 0))
+
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+def strip_options(argv: list[str], options: list[str]) -> list[str]:
+    """
+    Remove options that take a value from a command line, along with their values.
+    @param argv The command line.
+    @param options The option strings to remove, like ['-d', '--dataset'].
+    @return The rest of the command line.
+    """
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            # The value is the next argument.
+            skip = True
+        elif not any(arg.startswith(f"{option}=") if option.startswith('--') else arg.startswith(option)
+                     for option in options):
+            stripped.append(arg)
+
+    return stripped
+
+def launch_local_workers(count: int, argv: list[str]) -> int:
+    """
+    Run this script as a cluster of local worker processes, and wait for all of them to finish.
+    Every worker gets a TF_CONFIG describing the cluster and its place in it, and --distributed.
+    @param count How many worker processes to run.
+    @param argv The command line to run the workers with.
+    @return The exit code of the first worker to fail, or 0.
+    """
+    cluster = {'worker': [f"localhost:{port}" for port in free_ports(count)]}
+
+    workers = []
+    for index in range(count):
+        tf_config = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}})
+        workers.append(subprocess.Popen([sys.executable] + argv + ['--distributed'],
+                                        env=dict(os.environ, TF_CONFIG=tf_config)))
+
+    codes = [worker.wait() for worker in workers]
+
+    return next((code for code in codes if code != 0), 0)
+
+def distribute_dataset(strategy: tf.distribute.Strategy, dataset: tf.data.Dataset) \
+        -> tf.distribute.DistributedDataset:
+    """
+    Distribute a worker's own batched dataset as it is, without tf.distribute sharding or rebatching it again.
+    The dataset is repeated, so every worker can run the same number of steps no matter how large its part is.
+    """
+    dataset = dataset.repeat()
+    return strategy.distribute_datasets_from_function(lambda context: dataset)
+
+def fit_distributed(model: keras.Model, strategy: tf.distribute.Strategy, training_dataset: tf.data.Dataset,
+                    validation_dataset: tf.data.Dataset, epochs: int, steps_per_epoch: int, validation_steps: int,
+                    callbacks: list[keras.callbacks.Callback], initial_epoch=0) -> keras.callbacks.History:
+    """
+    Train a model created in the scope of a MultiWorkerMirroredStrategy, like model.fit() would.
+    Keras's own fit() can't reduce the input batches of a strategy with more than one worker yet.
+    Every worker passes its own part of the data, batched with its own batch size.
+    @param steps_per_epoch How many steps make an epoch. It must be the same on every worker.
+    @param validation_steps How many validation steps to run after each epoch, likewise.
+    @param initial_epoch The epoch to start at, when resuming a run.
+    @return The History of the training, like model.fit() returns.
+    """
+    training_iterator = iter(distribute_dataset(strategy, training_dataset))
+    validation_iterator = iter(distribute_dataset(strategy, validation_dataset))
+
+    def replica_loss(X: tf.Tensor, y: tf.Tensor, training: bool) -> tf.Tensor:
+        # Averaged over the global batch, so summing the replicas' losses gives the mean.
+        return tf.nn.compute_average_loss(tf.reshape(model.loss(y, model(X, training=training)), [-1]))
+
+    @tf.function
+    def train_step(iterator) -> tf.Tensor:
+        def step(X: tf.Tensor, y: tf.Tensor) -> tf.Tensor:
+            with tf.GradientTape() as tape:
+                loss = replica_loss(X, y, True)
+                # Only does anything with a mixed_float16 policy, where compile() adds loss scaling.
+                scaled_loss = model.optimizer.scale_loss(loss)
+
+            gradients = tape.gradient(scaled_loss, model.trainable_variables)
+            model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+
+        return strategy.reduce('SUM', strategy.run(step, args=next(iterator)), axis=None)
+
+    @tf.function
+    def validation_step(iterator) -> tf.Tensor:
+        return strategy.reduce('SUM', strategy.run(replica_loss, args=(*next(iterator), False)), axis=None)
+
+    # Only the chief shows the progress bar, the other workers would print the same thing.
+    history = keras.callbacks.History()
+    callbacks = keras.callbacks.CallbackList(callbacks + [history], add_progbar=strategy.cluster_resolver.task_id == 0,
+                                             model=model, verbose=1, epochs=epochs, steps=steps_per_epoch)
+
+    model.stop_training = False
+    logs = {}
+    callbacks.on_train_begin()
+
+    for epoch in range(initial_epoch, epochs):
+        callbacks.on_epoch_begin(epoch)
+
+        loss = 0.0
+        for step in range(steps_per_epoch):
+            callbacks.on_train_batch_begin(step)
+            loss += float(train_step(training_iterator))
+            callbacks.on_train_batch_end(step, {'loss': loss / (step + 1)})
+
+        val_loss = sum(float(validation_step(validation_iterator)) for _ in range(validation_steps))
+        logs = {'loss': loss / steps_per_epoch, 'val_loss': val_loss / validation_steps}
+        callbacks.on_epoch_end(epoch, logs)
+
+        if model.stop_training:
+            break
+
+    callbacks.on_train_end(logs)
+
+    return history
+
+def train_model(model: keras.Model, training_dataset: tf.data.Dataset, validation_dataset: tf.data.Dataset,
+                epochs=16, metrics_batches: int = None, batch_size=16, strategy: tf.distribute.Strategy = None,
+                steps_per_epoch: int = None, validation_steps: int = None, initial_epoch=0,
+                checkpoint_dir: str = None, checkpoint_every=1, patience=3, profile_dir: str = None,
+                profile_batches: tuple[int, int] = None, sampler: HardExampleSampler = None,
+                resume_state: dict = None):
+    """
+    Main routine that trains the model.
+    @param batch_size The global batch size, summed over all workers.
+    @param strategy The MultiWorkerMirroredStrategy the model was created in, to train it distributed.
+                    The datasets are then this worker's own parts, and the steps must be given.
+    @param steps_per_epoch How many steps make an epoch, when training distributed.
+    @param validation_steps How many validation steps to run after each epoch, when training distributed.
+    @param initial_epoch The epoch to start at, when resuming from a checkpoint.
+    @param checkpoint_dir Directory to save checkpoints in, or None to not save any.
+    @param checkpoint_every Save a checkpoint every this many epochs.
+    @param patience Stop once the validation loss hasn't improved for this many epochs, and go back to the
+                    weights of the best epoch. 0 to always train for all epochs.
+    @param profile_dir Directory to save the profiler trace in.
+    @param profile_batches Tuple of (first, last) training step to capture a profiler trace of, counted over
+                           the whole run, or None to not profile. The trace includes the tf.data pipeline.
+    @param sampler The HardExampleSampler the training dataset draws from, if any, to update after every epoch.
+    @param resume_state The early stopping state of the checkpoint the run resumes from, see load_checkpoint_state().
+    """
+    resume_state = resume_state or {}
+
+    # Callback function to score decodes on the validation set.
+    validation_callback = CallbackMetrics(validation_dataset, metrics_batches, strategy)
+    throughput_callback = CallbackThroughput(batch_size)
+    callbacks = [throughput_callback, validation_callback]
+
+    if sampler is not None:
+        callbacks.append(CallbackHardExamples(sampler))
+
+    # Before the checkpoints, so they save its state after the epoch.
+    early_stopping = None
+    if patience > 0:
+        early_stopping = CallbackEarlyStopping(patience, **resume_state)
+        callbacks.append(early_stopping)
+
+    if checkpoint_dir is not None:
+        callbacks.append(CallbackCheckpoint(checkpoint_dir, checkpoint_every, best=resume_state.get('best'),
+                                            early_stopping=early_stopping))
+
+    if profile_batches is not None:
+        callbacks.append(CallbackProfile(profile_dir, *profile_batches))
+
+    if strategy is not None:
+        return fit_distributed(model, strategy, training_dataset, validation_dataset, epochs,
+                               steps_per_epoch, validation_steps, callbacks, initial_epoch)
 
-    # Callback function to check decodes on the validation set.
-    validation_callback = CallbackEval(validation_dataset)
     return model.fit(
         training_dataset,
         validation_data=validation_dataset,
         epochs=epochs,
-        callbacks=[validation_callback],
+        initial_epoch=initial_epoch,
+        callbacks=callbacks,
     )
 
 def main():
     parser = argparse.ArgumentParser(
         prog='4chan-captcha-trainer',
         description='Trains the Keras model for the 4Chan CAPTCHA solver',
-        epilog='All specified datasets will be combined, shuffled, and split into the training/validation sets.'
+        epilog='All specified datasets will be combined and split into the training/validation sets. '
+               'The split is based on a hash of each solution, so it is the same on every run.'
     )
 
-    parser.add_argument('--dataset', '-d', action='append', required=True,
-                        help='Add a directory containing a dataset for training.')
+    datasets = parser.add_mutually_exclusive_group()
+    datasets.add_argument('--dataset', '-d', action='append',
+                          help='Add a directory containing a dataset for training.')
+    datasets.add_argument('--packed', '-p', action='append',
+                          help='Add a dataset packed by pack_dataset.py, which has its own training/validation split.')
+    datasets.add_argument('--split-manifest', action='store',
+                          help='Train on the exact training/validation split saved next to the model by an earlier run.')
+    parser.add_argument('--records', '-r', action='append',
+                        help='Add a directory, .json or .jsonl file of CAPTCHA saver records to train on directly. '
+                             'Slider CAPTCHAs are aligned on the fly. Can be combined with the other datasets.')
+    parser.add_argument('--dedup-index', action='store', default=None,
+                        help='Drop duplicate images from the --dataset directories before splitting them, using and '
+                             'updating this hash index from dedup_index.py.')
+    parser.add_argument('--model-config', action='store', default=None,
+                        help='JSON object of create_model() arguments, like the config column of sweep.py, '
+                             'e.g. \'{"conv_filters": [16, 32, 64], "dense_units": 64}\'. Defaults to the usual model.')
     parser.add_argument('--epochs', '-e', action='store', default=16,
                         help='How many epochs to train the model. Defaults to 16.')
+    parser.add_argument('--mixed-precision', action='store', choices=['float16', 'bfloat16'], default=None,
+                        help='Train with a mixed precision policy. bfloat16 is the one that helps on CPUs.')
+    parser.add_argument('--xla', action='store_true',
+                        help='Compile the training and inference steps with XLA.')
+    parser.add_argument('--metrics-batches', action='store', type=int, default=None,
+                        help='Only compute the validation accuracy/CER on this many batches. Defaults to all of them.')
+    parser.add_argument('--cache-bits', action='store', nargs='?', const='', default=None,
+                        help='Cache the encoded samples bit-packed (~3 KB each) after reading them once. '
+                             'Give a path prefix to keep the cache in memory-mapped files there, '
+                             'which later runs on the same samples reuse, otherwise it is kept in RAM.')
+    parser.add_argument('--synthetic-bank', action='store', default=None,
+                        help='Mix synthetic CAPTCHAs generated on the fly into the training data, '
+                             'using this background bank from extract_backgrounds.py.')
+    parser.add_argument('--synthetic-ratio', action='store', type=float, default=0.5,
+                        help='What fraction of the training samples should be synthetic, below 1. Defaults to 0.5.')
+    parser.add_argument('--characters', action='store', default=LABELS_DIR,
+                        help=f"The directory of character images for the synthetic CAPTCHAs. Defaults to {LABELS_DIR}.")
+    parser.add_argument('--hard-examples', action='store', type=float, default=None, metavar='TEMPERATURE',
+                        help='Draw the training samples of every epoch in favor of the ones with a high loss, '
+                             'instead of shuffling them. 1 draws them in proportion to their loss, higher values '
+                             'are closer to uniform. Needs --dataset, --split-manifest or --cache-bits.')
+    parser.add_argument('--hard-examples-floor', action='store', type=float, default=0.2,
+                        help='What fraction of the --hard-examples draws to spread evenly over all training '
+                             'samples, so the easy ones are still seen. Defaults to 0.2.')
+    parser.add_argument('--checkpoint-every', action='store', type=int, default=1,
+                        help='Save a checkpoint of the model and optimizer every this many epochs. Defaults to 1.')
+    parser.add_argument('--resume', action='store', default=None,
+                        help='Resume the run whose checkpoints are in this directory, from its latest checkpoint. '
+                             'New checkpoints go in the same directory.')
+    parser.add_argument('--patience', action='store', type=int, default=3,
+                        help='Stop early once the validation loss hasn\'t improved for this many epochs, and keep '
+                             'the weights of the best epoch. 0 turns early stopping off. Defaults to 3.')
+    parser.add_argument('--profile', action='store', default=None, metavar='FIRST,LAST',
+                        help='Capture a profiler trace, including the tf.data pipeline, of this range of training '
+                             'steps, e.g. 10,20. It is saved in models/*_profile, open it in TensorBoard\'s '
+                             'Profile tab.')
+    parser.add_argument('--batch-size', '-b', action='store', type=int, default=16,
+                        help='The batch size of every worker. The global batch size is this times the number of '
+                             'workers. Defaults to 16.')
+    parser.add_argument('--workers', '-w', action='store', type=int, default=1,
+                        help='Train with this many local worker processes, using tf.distribute. Defaults to 1.')
+    parser.add_argument('--distributed', action='store_true',
+                        help='Train as one worker of the tf.distribute cluster described by the TF_CONFIG '
+                             'environment variable. Run the same command on every worker.')
+    parser.add_argument('--cluster-spec', action='store', default=None,
+                        help='Train as one worker of the cluster in this JSON file, of the form '
+                             '{"worker": ["host:port", ...]}, instead of using TF_CONFIG. Needs --task-index.')
+    parser.add_argument('--task-index', action='store', type=int, default=None,
+                        help='The index of this machine in the --cluster-spec worker list. Worker 0 saves the model.')
 
     args = parser.parse_args()
 
-    dataset_paths = []
-    for root in args.dataset:
-        dataset_paths.extend(walk_png_files(root))
+    if not (args.dataset or args.packed or args.split_manifest or args.records):
+        parser.error('one of the arguments --dataset/-d --packed/-p --split-manifest --records/-r is required')
 
-    print(f"Found {len(dataset_paths)} image paths for training.")
+    # The records are read once per split, every epoch, and counted once more for distributed training.
+    if args.records and '-' in args.records:
+        parser.error('--records can\'t read from stdin, save the JSONL to a file first')
 
-    model = create_model()
-    model.summary(line_length=110)
-    history = train_model(model, dataset_paths, int(args.epochs))
+    # At 1 the real samples would never be drawn, so the epoch would never end.
+    if not 0 <= args.synthetic_ratio < 1:
+        parser.error('--synthetic-ratio must be at least 0 and below 1')
+
+    split_manifest = None
+    if args.split_manifest is not None:
+        try:
+            split_manifest = load_split_manifest(args.split_manifest)
+        except ValueError as e:
+            parser.error(str(e))
+
+        # The run the split comes from trained on these records as well.
+        if split_manifest[2] and not args.records:
+            print(f"Adding the saver records of {args.split_manifest}: {', '.join(split_manifest[2])}")
+            args.records = split_manifest[2]
+
+    model_config = {}
+    if args.model_config is not None:
+        try:
+            model_config = json.loads(args.model_config)
+        except json.JSONDecodeError as e:
+            parser.error(f"--model-config is not valid JSON: {e}")
+
+        if not isinstance(model_config, dict):
+            parser.error('--model-config must be a JSON object')
+
+        # jit_compile comes from --xla.
+        unknown = set(model_config) - (set(inspect.signature(create_model).parameters) - {'jit_compile'})
+        if unknown:
+            parser.error(f"--model-config has unknown create_model() arguments: {', '.join(sorted(unknown))}")
+
+    sampler = None
+    if args.hard_examples is not None:
+        if args.cache_bits is None and not (args.dataset or args.split_manifest):
+            parser.error('--hard-examples needs --dataset, --split-manifest or --cache-bits')
+        if args.hard_examples <= 0:
+            parser.error('--hard-examples needs a temperature above 0')
+        if not 0 <= args.hard_examples_floor <= 1:
+            parser.error('--hard-examples-floor must be between 0 and 1')
+
+        sampler = HardExampleSampler(args.hard_examples, args.hard_examples_floor)
+
+    profile_batches = None
+    if args.profile is not None:
+        try:
+            first, last = (int(step) for step in args.profile.split(','))
+        except ValueError:
+            parser.error('--profile needs two steps, like 10,20')
+
+        profile_batches = (first, last)
+
+    if args.cluster_spec is not None:
+        if args.task_index is None:
+            parser.error('--cluster-spec needs --task-index')
+
+        with open(args.cluster_spec, 'r') as fp:
+            cluster = json.load(fp)
+
+        os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': args.task_index}})
+        args.distributed = True
+
+    if args.dedup_index is not None and args.distributed:
+        parser.error('--dedup-index would have every worker hash the whole dataset, deduplicate it once first '
+                     '(e.g. with --workers, which saves the split in models/) and give the workers --split-manifest')
 
     now = datetime.datetime.now().strftime('%Y_%m_%d-%H:%M:%S')
+    os.makedirs('models', exist_ok=True)
+
+    if args.workers > 1 and not args.distributed:
+        worker_argv = sys.argv
+        if args.dedup_index is not None and args.dataset:
+            # Deduplicate once here, rather than in every worker, and give the workers the resulting split.
+            training_paths, validation_paths = split_paths(find_dataset_paths(args.dataset, args.dedup_index))
+            dedup_manifest_path = os.path.join('models', f"4ChanCaptcha-{now}_dedup_split.json")
+            save_split_manifest(dedup_manifest_path, training_paths, validation_paths, records=args.records)
+
+            worker_argv = strip_options(sys.argv, ['-d', '--dataset', '--dedup-index']) + \
+                          ['--split-manifest', dedup_manifest_path]
+
+        sys.exit(launch_local_workers(args.workers, worker_argv))
+
+    # The strategy has to exist before any other TF op runs.
+    strategy = None
+    worker_count = 1
+    worker_index = 0
+    if args.distributed:
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        worker_count = strategy.cluster_resolver.cluster_spec().num_tasks('worker')
+        worker_index = strategy.cluster_resolver.task_id
+
+        print(f"Worker {worker_index} of {worker_count}, "
+              f"global batch size {args.batch_size * strategy.num_replicas_in_sync}")
+
+    # Worker 0 is the chief, which writes the model and the other outputs.
+    is_chief = worker_index == 0
+    shard = (worker_count, worker_index) if strategy is not None else None
+
+    synthetic = None
+    if args.synthetic_bank is not None:
+        synthetic = load_synthetic_dataset(args.synthetic_bank, args.characters)
+
+    manifest_path = os.path.join('models', f"4ChanCaptcha-{now}_split.json")
+
+    if args.packed:
+        training_samples, validation_samples = load_packed_splits(args.packed, shard)
+        training_count = sum(packed_sample_count(root, 'train') for root in args.packed) // worker_count
+        validation_count = sum(packed_sample_count(root, 'validation') for root in args.packed) // worker_count
+
+        training_sources = validation_sources = list(args.packed)
+
+        # Packed datasets carry their own split.
+        if is_chief:
+            save_split_manifest(manifest_path, args.packed, args.packed, 'packed', records=args.records)
+    elif args.dataset or args.split_manifest:
+        if args.split_manifest is not None:
+            training_paths, validation_paths, _ = split_manifest
+        else:
+            training_paths, validation_paths = split_paths(find_dataset_paths(args.dataset, args.dedup_index))
+
+        if is_chief:
+            save_split_manifest(manifest_path, training_paths, validation_paths, records=args.records)
+
+        # Counted before sharding, so every worker gets the same number of steps.
+        training_count = len(training_paths) // worker_count
+        validation_count = len(validation_paths) // worker_count
+
+        if shard is not None:
+            training_paths = shard_paths(training_paths, *shard)
+            validation_paths = shard_paths(validation_paths, *shard)
+
+        if sampler is not None and args.cache_bits is None:
+            training_samples = encode_sampled_paths(training_paths, sampler, args.batch_size)
+        else:
+            training_samples = encode_paths(training_paths)
+        validation_samples = encode_paths(validation_paths, shuffle=False)
+        training_sources, validation_sources = training_paths, validation_paths
+    else:
+        training_samples = validation_samples = None
+        training_sources = validation_sources = []
+        training_count = validation_count = 0
+
+        # Like packed datasets, the records are split by themselves.
+        if is_chief:
+            save_split_manifest(manifest_path, args.records, args.records, 'records')
+
+    if args.records:
+        record_training = load_saver_records(args.records, 'train', shard=shard)
+        record_validation = load_saver_records(args.records, 'validation', shard=shard, shuffle=False)
+
+        if strategy is not None:
+            # The steps per epoch need the number of records, which means reading them all once.
+            training_count += sum(1 for _ in iter_saver_records(args.records, 'train')) // worker_count
+            validation_count += sum(1 for _ in iter_saver_records(args.records, 'validation')) // worker_count
+
+        if training_samples is None:
+            training_samples, validation_samples = record_training, record_validation
+        else:
+            training_samples = tf.data.Dataset.sample_from_datasets([training_samples, record_training])
+            validation_samples = validation_samples.concatenate(record_validation)
+
+    if args.cache_bits is not None:
+        cache_path = args.cache_bits or None
+        if cache_path is not None and shard is not None:
+            cache_path = f"{cache_path}-{worker_index}of{worker_count}"
+
+        # The saver records aren't always counted up front, but their size and modification time are fingerprinted.
+        records = args.records or []
+        training_dataset = load_bit_cached_dataset(
+            training_samples, cache_path and f"{cache_path}-train", args.batch_size,
+            synthetic=synthetic, synthetic_ratio=args.synthetic_ratio, sampler=sampler,
+            fingerprint=cache_fingerprint(training_sources + records, training_count)
+        )
+        validation_dataset = load_bit_cached_dataset(
+            validation_samples, cache_path and f"{cache_path}-validation", args.batch_size, shuffle=False,
+            fingerprint=cache_fingerprint(validation_sources + records, validation_count)
+        )
+    else:
+        training_dataset = batch_dataset(training_samples, args.batch_size,
+                                         synthetic=synthetic, synthetic_ratio=args.synthetic_ratio)
+        # The validation samples never change, so only decode them on the first epoch.
+        validation_dataset = batch_dataset(cache_samples(validation_samples), args.batch_size)
+
+    if args.mixed_precision is not None:
+        keras.mixed_precision.set_global_policy(f"mixed_{args.mixed_precision}")
+
+    if strategy is not None:
+        # Every worker has to run the same number of steps, or the ones that run out first leave the others
+        # waiting on them forever. The parts can differ in size a little, so the datasets repeat instead.
+        if synthetic is not None and args.synthetic_ratio > 0:
+            training_count = int(training_count / (1 - args.synthetic_ratio))
+
+        fit_args = {
+            'batch_size': args.batch_size * strategy.num_replicas_in_sync,
+            'strategy': strategy,
+            'steps_per_epoch': max(training_count // args.batch_size, 1),
+            'validation_steps': max(validation_count // args.batch_size, 1),
+        }
+
+        with strategy.scope():
+            model = create_model(args.xla, **model_config)
+    else:
+        fit_args = {'batch_size': args.batch_size}
+        model = create_model(args.xla, **model_config)
+
+    checkpoint_dir = args.resume or os.path.join('models', f"4ChanCaptcha-{now}_checkpoints")
+    initial_epoch = 0
+    resume_state = {}
+
+    if args.resume is not None:
+        checkpoints = list_checkpoints(args.resume)
+        if not checkpoints:
+            print(f"No checkpoints in {args.resume}, starting from scratch.")
+        else:
+            initial_epoch, checkpoint_path = checkpoints[-1]
+            print(f"Resuming from {checkpoint_path}, after epoch {initial_epoch}.")
+            resume_state = load_checkpoint_state(args.resume, initial_epoch)
+
+            if strategy is not None:
+                with strategy.scope():
+                    restore_checkpoint(model, checkpoint_path)
+            else:
+                restore_checkpoint(model, checkpoint_path)
+
+    if is_chief:
+        model.summary(line_length=110)
+
+    history = train_model(model, training_dataset, validation_dataset, int(args.epochs), args.metrics_batches,
+                          initial_epoch=initial_epoch, checkpoint_dir=checkpoint_dir if is_chief else None,
+                          checkpoint_every=args.checkpoint_every, patience=args.patience,
+                          profile_dir=os.path.join('models', f"4ChanCaptcha-{now}_profile"),
+                          profile_batches=profile_batches if is_chief else None, sampler=sampler,
+                          resume_state=resume_state, **fit_args)
+
+    if not is_chief:
+        return
+
     model.save(os.path.join('models', f"4ChanCaptcha-{now}.h5"))
 
     # Create and save the loss graph
     print(history.history)
-    epochs = range(1, len(history.history['loss']) + 1)
+    epochs = range(initial_epoch + 1, initial_epoch + len(history.history['loss']) + 1)
 
     plt.figure(figsize=(10, 6))
     plt.plot(epochs, history.history['loss'])
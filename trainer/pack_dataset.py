@@ -0,0 +1,205 @@
+"""
+Script to pack dataset directories into sharded TFRecord files, holding the samples exactly as encode_sample()
+produces them, so training doesn't have to decode and threshold every PNG again on every epoch.
+
+The packed dataset is a directory with an index.json, listing the shards of the training and validation splits.
+Load it with load_packed_dataset(), or pass it to main.py with --packed.
+"""
+import os
+import json
+import random
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from common import encode_sample, get_file_label, split_paths, walk_png_files
+
+INDEX_NAME = 'index.json'
+IMAGE_SHAPE = (300, 80, 1)
+LABEL_LENGTH = 6
+
+def serialize_sample(image: np.ndarray, label: np.ndarray, text: str) -> bytes:
+    """
+    Serialize an encoded sample as a tf.train.Example.
+    @param image The (300, 80, 1) image from encode_sample(), of 0s and 1s.
+    @param label The encoded label from encode_sample().
+    @param text The solution text, kept so the sample can be identified later.
+    """
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.astype(np.uint8).tobytes()])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=label)),
+        'text': tf.train.Feature(bytes_list=tf.train.BytesList(value=[text.encode('utf-8')])),
+    }))
+
+    return example.SerializeToString()
+
+def write_shards(paths: list[str], outdir: str, prefix: str, shard_size: int, compression: str) -> list[dict]:
+    """
+    Encode the images at the given paths and write them into TFRecord shards.
+    @param paths The list of image paths, named {sol}.png.
+    @param outdir Directory to write the shards in.
+    @param prefix Prefix for the shard file names.
+    @param shard_size Maximum number of samples per shard.
+    @param compression TFRecord compression type, 'GZIP' or ''.
+    @return List of {'file': name, 'count': samples} dicts, one per shard.
+    """
+    texts = [get_file_label(path) for path in paths]
+
+    # Decoding is done on the tf.data thread pool, writing happens here in order.
+    encoded = tf.data.Dataset.from_tensor_slices((paths, texts)) \
+                             .map(encode_sample, num_parallel_calls=tf.data.AUTOTUNE) \
+                             .prefetch(tf.data.AUTOTUNE)
+
+    options = tf.io.TFRecordOptions(compression_type=compression)
+    shards = []
+    writer = None
+
+    for i, ((image, label), text) in enumerate(zip(encoded.as_numpy_iterator(), texts)):
+        if i % shard_size == 0:
+            if writer is not None:
+                writer.close()
+
+            shards.append({'file': f"{prefix}-{len(shards):05d}.tfrecord", 'count': 0})
+            writer = tf.io.TFRecordWriter(os.path.join(outdir, shards[-1]['file']), options)
+
+        writer.write(serialize_sample(image, label, text))
+        shards[-1]['count'] += 1
+
+    if writer is not None:
+        writer.close()
+
+    return shards
+
+def pack_dataset(paths: list[str], outdir: str, validation_fraction=0.1, shard_size=10000,
+                 compression='GZIP') -> dict:
+    """
+    Pack the images at the given paths into a training and a validation split of TFRecord shards.
+    @param paths The list of image paths, named {sol}.png.
+    @param outdir Directory to write the packed dataset in.
+    @param validation_fraction What fraction of the samples to put in the validation split.
+    @param shard_size Maximum number of samples per shard.
+    @param compression TFRecord compression type, 'GZIP' or ''.
+    @return The index, as written to index.json.
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    training_paths, validation_paths = split_paths(paths, 1 - validation_fraction)
+
+    # Mix up the source directories across the training shards, the loader only shuffles within a window.
+    random.Random(0).shuffle(training_paths)
+
+    index = {
+        'image_shape': list(IMAGE_SHAPE),
+        'label_length': LABEL_LENGTH,
+        'compression': compression,
+        'splits': {
+            'train': write_shards(training_paths, outdir, 'train', shard_size, compression),
+            'validation': write_shards(validation_paths, outdir, 'validation', shard_size, compression),
+        },
+    }
+
+    with open(os.path.join(outdir, INDEX_NAME), 'w') as fp:
+        json.dump(index, fp, indent=2)
+
+    return index
+
+def parse_packed_sample(record: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+    """
+    Parse a serialized sample back into the (image, label) tensors encode_sample() produces.
+    """
+    features = tf.io.parse_single_example(record, {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([LABEL_LENGTH], tf.int64),
+    })
+
+    image = tf.io.decode_raw(features['image'], tf.uint8)
+    image = tf.cast(tf.reshape(image, IMAGE_SHAPE), tf.float32)
+
+    return image, features['label']
+
+def packed_sample_count(root: str, split: str) -> int:
+    """
+    Count the samples in a split of a packed dataset, from its index.
+    @param root Directory of the packed dataset.
+    @param split Which split to count, 'train' or 'validation'.
+    """
+    with open(os.path.join(root, INDEX_NAME), 'r') as fp:
+        index = json.load(fp)
+
+    return sum(shard['count'] for shard in index['splits'][split])
+
+def load_packed_dataset(root: str, split: str, shuffle=True, shard: tuple[int, int] = None) -> tf.data.Dataset:
+    """
+    Load an unbatched tf.data.Dataset of encoded samples from a packed dataset.
+    The shards are read in parallel, interleaved with each other.
+    @param root Directory of the packed dataset.
+    @param split Which split to load, 'train' or 'validation'.
+    @param shuffle Whether to shuffle the shard order and the samples.
+    @param shard Optional tuple of (count, index), to only load every count-th part of the samples,
+                 starting at index. Used to give every worker of a distributed run its own part.
+    @return tf.data.Dataset of (image, label) samples, like encode_sample() produces.
+    """
+    with open(os.path.join(root, INDEX_NAME), 'r') as fp:
+        index = json.load(fp)
+
+    files = [os.path.join(root, entry['file']) for entry in index['splits'][split]]
+    compression = index['compression']
+
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+
+    # Split whole files between the workers if there are enough of them, otherwise split the records,
+    # which needs the files to be read in the same order by every worker.
+    shard_records = shard is not None and len(files) < shard[0]
+    if shard is not None and not shard_records:
+        dataset = dataset.shard(*shard)
+
+    if shuffle and not shard_records:
+        dataset = dataset.shuffle(len(files))
+
+    dataset = dataset.interleave(
+        lambda file: tf.data.TFRecordDataset(file, compression_type=compression),
+        cycle_length=tf.data.AUTOTUNE, num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=shard_records or not shuffle
+    )
+
+    if shard_records:
+        dataset = dataset.shard(*shard)
+
+    if shuffle:
+        dataset = dataset.shuffle(4096)
+
+    return dataset.map(parse_packed_sample, num_parallel_calls=tf.data.AUTOTUNE)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='4chan-captcha-packer',
+        description='Packs datasets into sharded TFRecord files of preprocessed samples, for main.py --packed.'
+    )
+    parser.add_argument('--dataset', '-d', action='append', required=True,
+                        help='Add a directory containing a dataset to pack.')
+    parser.add_argument('--out', '-o', action='store', required=True,
+                        help='The directory to write the packed dataset in.')
+    parser.add_argument('--validation-fraction', action='store', type=float, default=0.1,
+                        help='What fraction of the samples to put in the validation split. Defaults to 0.1.')
+    parser.add_argument('--shard-size', action='store', type=int, default=10000,
+                        help='How many samples to put in each shard. Defaults to 10000.')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Write uncompressed shards, which are ~10x bigger but a little cheaper to read.')
+
+    args = parser.parse_args()
+
+    paths = []
+    for root in args.dataset:
+        paths.extend(walk_png_files(root))
+
+    print(f"Packing {len(paths)} images.")
+
+    index = pack_dataset(paths, args.out, args.validation_fraction, args.shard_size,
+                         '' if args.no_compression else 'GZIP')
+
+    for split, shards in index['splits'].items():
+        print(f"{split}: {sum(shard['count'] for shard in shards)} samples in {len(shards)} shards")
+
+if __name__ == '__main__':
+    main()
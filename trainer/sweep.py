@@ -0,0 +1,276 @@
+"""
+Script to sweep model architectures and hyperparameters, training many configurations side by side.
+
+The grid is the product of the given create_model() options. The samples are decoded once into a bit-packed cache on
+disk, which every worker process memory-maps, so the workers share one copy of the dataset through the page cache.
+Each configuration is trained in its own worker, with an even share of the CPU threads, and saved. Once they are all
+trained, the CPU latency of every model is measured one at a time, so the measurements don't compete with training.
+The best validation accuracy, parameter count and latency of every configuration go into a results table, from which
+the fastest configuration that meets --accuracy is picked.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+def parse_ints(value: str) -> list[int]:
+    """ Parse a comma separated list of integers, like 32,64,128. """
+    return [int(part) for part in value.split(',')]
+
+def grid_configs(conv_filters: list[list[int]], dense_units: list[int], dropout: list[float],
+                 lstm_units: list[list[int]]) -> list[dict]:
+    """
+    Get every combination of the given create_model() options.
+    @return List of dicts of create_model() arguments.
+    """
+    return [
+        {'conv_filters': conv, 'dense_units': dense, 'dropout': rate, 'lstm_units': lstm}
+        for conv, dense, rate, lstm in itertools.product(conv_filters, dense_units, dropout, lstm_units)
+    ]
+
+def config_name(config: dict) -> str:
+    """ Get a short name for a configuration, to name its saved model with. """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def build_cache(cache_prefix: str, datasets: list[str], packed: list[str]) -> (int, int):
+    """
+    Decode the samples into bit-packed caches for the workers, or reuse the caches that are already there, if they
+    were built from the same samples.
+    @param cache_prefix Path prefix of the caches, {prefix}-train and {prefix}-validation.
+    @param datasets Directories of images named {sol}.png, split like main.py splits them.
+    @param packed Datasets packed by pack_dataset.py, with their own split.
+    @return Tuple of (training sample count, validation sample count).
+    """
+    from bitcache import BitCache, cache_fingerprint
+    from common import split_paths, walk_png_files
+    from main import encode_paths, load_packed_splits
+    from pack_dataset import packed_sample_count
+
+    if packed:
+        training, validation = load_packed_splits(packed)
+        training_fingerprint = cache_fingerprint(packed, sum(packed_sample_count(root, 'train') for root in packed))
+        validation_fingerprint = cache_fingerprint(packed, sum(packed_sample_count(root, 'validation')
+                                                               for root in packed))
+    else:
+        paths = []
+        for root in datasets:
+            paths.extend(walk_png_files(root))
+
+        training_paths, validation_paths = split_paths(paths)
+        training = encode_paths(training_paths, shuffle=False)
+        validation = encode_paths(validation_paths, shuffle=False)
+        training_fingerprint = cache_fingerprint(training_paths, len(training_paths))
+        validation_fingerprint = cache_fingerprint(validation_paths, len(validation_paths))
+
+    return len(BitCache.build(training, f"{cache_prefix}-train", fingerprint=training_fingerprint)), \
+           len(BitCache.build(validation, f"{cache_prefix}-validation", fingerprint=validation_fingerprint))
+
+def run_in_fresh_process(context: multiprocessing.context.BaseContext, function, *args):
+    """
+    Run a function in a new worker process of its own, which exits once the function returns.
+    @param context The multiprocessing context to start the process with.
+    @return What the function returns.
+    """
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+def run_config(config: dict, cache_prefix: str, models_dir: str, epochs: int, batch_size: int, patience: int,
+               threads: int) -> dict:
+    """
+    Train one configuration, and save the model with the weights of its best epoch. This runs in the worker processes.
+    @param config Dict of create_model() arguments.
+    @param cache_prefix Path prefix of the caches built by build_cache().
+    @param models_dir Directory to save the model in.
+    @param epochs The maximum number of epochs to train for.
+    @param batch_size The batch size to train with.
+    @param patience Stop once the validation loss hasn't improved for this many epochs.
+    @param threads How many CPU threads this worker may use.
+    @return Dict of the results, without the latency yet.
+    """
+    import tensorflow as tf
+
+    # This has to happen before TF runs anything.
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    from bitcache import BitCache
+    from main import create_model, train_model
+
+    training = BitCache.load(f"{cache_prefix}-train")
+    validation = BitCache.load(f"{cache_prefix}-validation")
+
+    model = create_model(**config)
+
+    start = time.perf_counter()
+    history = train_model(model, training.dataset(batch_size), validation.dataset(batch_size, shuffle=False),
+                          epochs, batch_size=batch_size, patience=patience)
+    elapsed = time.perf_counter() - start
+
+    path = os.path.join(models_dir, f"{config_name(config)}.keras")
+    model.save(path)
+
+    return {
+        'config': config,
+        'model': path,
+        'val_accuracy': max(history.history['val_accuracy']),
+        'val_cer': min(history.history['val_cer']),
+        'params': model.count_params(),
+        'latency_ms': None,
+        'epochs': len(history.history['loss']),
+        'train_seconds': elapsed,
+    }
+
+def measure_models(paths: list[str], cache_prefix: str) -> list[float]:
+    """
+    Measure the CPU latency of solving one CAPTCHA with each of the saved models, one model at a time.
+    This runs in a worker process of its own, once training is done.
+    @param paths The paths of the models saved by run_config().
+    @param cache_prefix Path prefix of the caches built by build_cache(), to take a validation image from.
+    @return The latency of each model in milliseconds.
+    """
+    import keras
+
+    from bitcache import BitCache
+    from export_model import measure_latency
+
+    image = next(iter(BitCache.load(f"{cache_prefix}-validation").dataset(1, shuffle=False)))[0][0].numpy()
+
+    latencies = []
+    for path in paths:
+        model = keras.models.load_model(path, compile=False)
+        latencies.append(measure_latency(lambda batch: model.predict_on_batch(batch), image))
+
+    return latencies
+
+def print_results(results: list[dict], accuracy: float):
+    """ Print the results table, fastest first, and the fastest configuration that meets the accuracy bar. """
+    results = sorted((result for result in results if result['latency_ms'] is not None),
+                     key=lambda result: result['latency_ms'])
+
+    print(f"{'latency (ms)':>12}{'params':>10}{'accuracy':>10}{'CER':>8}{'epochs':>8}  config")
+    for result in results:
+        print(f"{result['latency_ms']:>12.2f}{result['params']:>10}{result['val_accuracy']:>10.4f}"
+              f"{result['val_cer']:>8.4f}{result['epochs']:>8}  {json.dumps(result['config'])}")
+
+    acceptable = [result for result in results if result['val_accuracy'] >= accuracy]
+    if acceptable:
+        print(f"Fastest configuration with at least {accuracy} accuracy: {json.dumps(acceptable[0]['config'])}")
+    else:
+        print(f"No configuration reached {accuracy} accuracy.")
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Trains a grid of model configurations in parallel, and reports their validation accuracy, '
+                    'parameter count and CPU latency.'
+    )
+    datasets = parser.add_mutually_exclusive_group(required=True)
+    datasets.add_argument('-d', '--dataset', action='append',
+                          help='Add a directory of images named {sol}.png, split like main.py splits them.')
+    datasets.add_argument('-p', '--packed', action='append',
+                          help='Add a dataset packed by pack_dataset.py.')
+    parser.add_argument('--conv-filters', action='append', type=parse_ints, default=None,
+                        help='Filters of each convolution, e.g. 32,64,128. Can be given more than once.')
+    parser.add_argument('--dense-units', action='append', type=int, default=None,
+                        help='Size of the dense layer. Can be given more than once.')
+    parser.add_argument('--dropout', action='append', type=float, default=None,
+                        help='Dropout rate after the dense layer. Can be given more than once.')
+    parser.add_argument('--lstm-units', action='append', type=parse_ints, default=None,
+                        help='Size of each bidirectional LSTM, e.g. 128,64. Can be given more than once.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=2,
+                        help='How many configurations to train at once. Defaults to 2.')
+    parser.add_argument('-e', '--epochs', action='store', type=int, default=16,
+                        help='The maximum number of epochs to train every configuration for. Defaults to 16.')
+    parser.add_argument('-b', '--batch-size', action='store', type=int, default=16,
+                        help='The batch size. Defaults to 16.')
+    parser.add_argument('--patience', action='store', type=int, default=3,
+                        help='Stop a configuration once its validation loss hasn\'t improved for this many epochs. '
+                             'Defaults to 3.')
+    parser.add_argument('--cache', action='store', default='sweep-cache',
+                        help='Path prefix of the shared sample cache. An existing cache of the same samples there '
+                             'is reused. Defaults to sweep-cache.')
+    parser.add_argument('--models', action='store', default='sweep-models',
+                        help='Directory to save the model of every configuration in. Defaults to sweep-models.')
+    parser.add_argument('--accuracy', action='store', type=float, default=0.9,
+                        help='The validation accuracy a configuration needs to be picked. Defaults to 0.9.')
+    parser.add_argument('-o', '--out', action='store', default='sweep.jsonl',
+                        help='File to append the result of every configuration to, as it finishes. '
+                             'Configurations already in it are skipped. Defaults to sweep.jsonl.')
+
+    args = parser.parse_args(argv[1:])
+
+    configs = grid_configs(args.conv_filters or [[32, 64, 128]], args.dense_units or [128],
+                           args.dropout or [0.3], args.lstm_units or [[128, 64]])
+
+    results = []
+    if os.path.exists(args.out):
+        with open(args.out, 'r') as fp:
+            for line in fp:
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Probably a line cut short by an interrupted run.
+                    continue
+
+    done = [result['config'] for result in results]
+    pending = [config for config in configs if config not in done]
+    print(f"{len(configs)} configurations, {len(configs) - len(pending)} already done.")
+
+    # The cache is built in a worker too, so this process never loads TF and the workers start from a clean state.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        training_count, validation_count = executor.submit(build_cache, args.cache, args.dataset, args.packed).result()
+    print(f"Sharing {training_count} training and {validation_count} validation samples from {args.cache}-*")
+
+    threads = max((os.cpu_count() or 1) // args.workers, 1)
+    os.makedirs(args.models, exist_ok=True)
+
+    # Every configuration gets a fresh process, so the memory of the finished ones is given back.
+    # The threads only wait on those processes.
+    with open(args.out, 'a') as out, ThreadPoolExecutor(args.workers) as executor:
+        futures = {
+            executor.submit(run_in_fresh_process, context, run_config, config, args.cache, args.models, args.epochs,
+                            args.batch_size, args.patience, threads): config
+            for config in pending
+        }
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{json.dumps(futures[future])} failed: {e}")
+                continue
+
+            print(f"{json.dumps(result['config'])}: accuracy {result['val_accuracy']:.4f}, {result['params']} params")
+            results.append(result)
+
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+
+    unmeasured = [result for result in results if result['latency_ms'] is None and os.path.exists(result['model'])]
+    if unmeasured:
+        print(f"Measuring the latency of {len(unmeasured)} models.")
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            latencies = executor.submit(measure_models, [result['model'] for result in unmeasured], args.cache).result()
+
+        for result, latency in zip(unmeasured, latencies):
+            result['latency_ms'] = latency
+
+        # Replace the results file only once the new one is completely written.
+        with open(f"{args.out}.tmp", 'w') as fp:
+            for result in results:
+                fp.write(json.dumps(result) + '\n')
+        os.replace(f"{args.out}.tmp", args.out)
+
+    print_results([result for result in results if result['config'] in configs], args.accuracy)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
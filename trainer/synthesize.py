@@ -3,13 +3,18 @@ Script to generate a synthetic CAPTCHA dataset, using existing CAPTCHA backgroun
 and images of known characters.
 """
 import os
+import time
 import random
 import argparse
+import multiprocessing
+
+from typing import Iterator
 
 import cv2
 import numpy as np
 
-from common import walk_png_files, CHARACTER_SET
+from common_lite import walk_png_files, CHARACTER_SET
+from timing import Timings
 
 # Observed values from looking at a ton of CAPTCHAs.
 LAYOUTS = [
@@ -55,41 +60,50 @@ LAYOUTS = [
     }
 ]
 
+# We have fewer 5-char layouts in the LAYOUTS array, so weight them a little heavier.
+LAYOUT_WEIGHTS = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.2, 0.2]
+
 LABELS_DIR = 'characters/'
 
-def place_character_image(background: np.ndarray, foreground: np.ndarray, x_offset: int, y_offset: int) -> np.ndarray:
+def composite_characters(background: np.ndarray,
+                         characters: list[tuple[np.ndarray, np.ndarray, int, int]]) -> np.ndarray:
     """
-    Combine a CAPTCHA letter image with the background image, at the given x and y offsets.
+    Combine CAPTCHA letter images with the background image in place, in order, each at its x and y offsets.
+    The letters are either fully opaque or fully transparent, so compositing them is a masked copy, done in uint8
+    without any temporary arrays.
+
+    @param background (height, width, 3) uint8 BGR background image. It is modified.
+    @param characters List of (colors, mask, x_offset, y_offset) tuples, with the (h, w, 3) uint8 BGR colors of a
+                      letter image and the (h, w, 1) bool mask of its opaque pixels, like GlyphBank.sample_masked()
+                      returns.
+    @return The background image.
     """
     bg_h, bg_w, _ = background.shape
-    fg_h, fg_w, _ = foreground.shape
-
-    w = min(fg_w, bg_w, fg_w + x_offset, bg_w - x_offset)
-    h = min(fg_h, bg_h, fg_h + y_offset, bg_h - y_offset)
 
-    # Grab the region of the background that the forground image overlaps with.
-    bg_x = max(0, x_offset)
-    bg_y = max(0, y_offset)
-    fg_x = max(0, x_offset * -1)
-    fg_y = max(0, y_offset * -1)
-    foreground = foreground[fg_y:fg_y + h, fg_x:fg_x + w]
-    background_subsection = background[bg_y:bg_y + h, bg_x:bg_x + w]
+    for colors, mask, x_offset, y_offset in characters:
+        fg_h, fg_w, _ = colors.shape
 
-    # Pull out the color and alpha channels from the overlay.
-    foreground_colors = foreground[:, :, :3]
-    alpha_channel = foreground[:, :, 3] / 255
+        w = min(fg_w, bg_w, fg_w + x_offset, bg_w - x_offset)
+        h = min(fg_h, bg_h, fg_h + y_offset, bg_h - y_offset)
 
-    # Make an alpha mask that has the same shape as the overlay image's alpha.
-    alpha_mask = np.dstack((alpha_channel, alpha_channel, alpha_channel))
+        # Grab the region of the background that the forground image overlaps with.
+        bg_x = max(0, x_offset)
+        bg_y = max(0, y_offset)
+        fg_x = max(0, x_offset * -1)
+        fg_y = max(0, y_offset * -1)
 
-    # Composite the character image onto the background area.
-    composite = background_subsection * (1 - alpha_mask) + foreground_colors * alpha_mask
-
-    # Update the background image with the combined area.
-    background[bg_y:bg_y + h, bg_x:bg_x + w] = composite
+        np.copyto(background[bg_y:bg_y + h, bg_x:bg_x + w], colors[fg_y:fg_y + h, fg_x:fg_x + w],
+                  where=mask[fg_y:fg_y + h, fg_x:fg_x + w])
 
     return background
 
+def place_character_image(background: np.ndarray, foreground: np.ndarray, x_offset: int, y_offset: int) -> np.ndarray:
+    """
+    Combine a CAPTCHA letter image with the background image, at the given x and y offsets.
+    The alpha channel of the letter image must be 0 or 255, like the images of a GlyphBank.
+    """
+    return composite_characters(background, [(foreground[..., :3], foreground[..., 3:] >= 128, x_offset, y_offset)])
+
 
 def isolate_background(img: cv2.UMat) -> cv2.UMat:
     """
@@ -117,87 +131,309 @@ def isolate_background(img: cv2.UMat) -> cv2.UMat:
     # Convert it back to a 3-channel image.
     return cv2.merge((img, img, img))
 
-def generate_unique_label(length: int, outdir: str) -> int:
+def load_background_bank(path: str) -> np.ndarray:
+    """
+    Memory-map a background bank written by extract_backgrounds.py.
+
+    @param path Path of the .npy file.
+    @return Read-only (count, 80, 300) uint8 array of isolated backgrounds.
+    """
+    bank = np.load(path, mmap_mode='r')
+
+    # Otherwise sampling from it fails much later, deep inside a tf.data pipeline.
+    if len(bank) == 0:
+        raise ValueError(f"the background bank {path} is empty, none of its source images could be read")
+
+    return bank
+
+def sample_background(bank: np.ndarray, rng: random.Random = random) -> np.ndarray:
+    """
+    Pick a random background from a background bank.
+
+    @param bank Array returned by load_background_bank().
+    @param rng Random instance to pick the background with.
+    @return A new 3-channel (80, 300, 3) background image, like isolate_background() returns.
+    """
+    img = bank[rng.randrange(len(bank))]
+
+    return cv2.merge((img, img, img))
+
+def generate_unique_label(length: int, used: set[str], rng: random.Random = random) -> str:
     """
-    Generate a label of the given length, that doesn't already exist in the outdir.
+    Generate a label of the given length, that isn't in the set of used labels, and add it to the set.
+
+    @param length Number of characters in the label.
+    @param used Set of labels that already exist.
+    @param rng Random instance to draw the characters from.
     """
     while True:
-        label = ''.join(random.choice(CHARACTER_SET[1:]) for _ in range(length))
+        label = ''.join(rng.choice(CHARACTER_SET[1:]) for _ in range(length))
 
-        if not os.path.exists(os.path.join(outdir, f"{label}.png")):
+        if label not in used:
+            used.add(label)
             return label
 
 
+class GlyphBank:
+    """
+    Every character image under the labels dir, loaded once and kept in memory.
+    The glyphs are stored already resized to each layout size, with their alpha channel precomputed,
+    as one (count, height, width, 4) uint8 array per character and size, plus the alpha as a bool mask.
+    """
+
+    def __init__(self, labels_dir: str = LABELS_DIR, sizes: list[tuple[int, int]] = None):
+        """
+        @param labels_dir Directory containing one directory of character images per character.
+        @param sizes List of (width, height) sizes to prepare the glyphs in. Defaults to every size in LAYOUTS.
+        """
+        if sizes is None:
+            sizes = sorted({layout['size'] for layout in LAYOUTS})
+
+        self.glyphs = {}
+        self.masks = {}
+
+        for c in CHARACTER_SET[1:]:
+            char_dir = os.path.join(labels_dir, c)
+            images = [cv2.imread(os.path.join(char_dir, filename)) for filename in sorted(os.listdir(char_dir))]
+            images = [img for img in images if img is not None]
+
+            for size in sizes:
+                resized = np.stack([cv2.resize(img, size, interpolation=cv2.INTER_NEAREST) for img in images])
+
+                # Alpha of 0 if black, 255 if white.
+                alpha = np.uint8(np.where(resized[..., -1] == 0, 255, 0))
+
+                self.glyphs[(c, size)] = np.concatenate((resized, alpha[..., np.newaxis]), axis=-1)
+                self.masks[(c, size)] = alpha[..., np.newaxis] != 0
+
+    def sample(self, c: str, size: tuple[int, int], rng: random.Random = random) -> np.ndarray:
+        """
+        Pick a random image of the given character.
+
+        @param c The character.
+        @param size (width, height) size of the character image.
+        @param rng Random instance to pick the image with.
+        @return BGRA image of the character. This is a view into the bank, so it must not be modified.
+        """
+        glyphs = self.glyphs[(c, size)]
+
+        return glyphs[rng.randrange(len(glyphs))]
+
+    def sample_masked(self, c: str, size: tuple[int, int], rng: random.Random = random) -> (np.ndarray, np.ndarray):
+        """
+        Pick a random image of the given character, like sample(), along with its precomputed mask.
+
+        @param c The character.
+        @param size (width, height) size of the character image.
+        @param rng Random instance to pick the image with.
+        @return Tuple of (BGR colors, bool mask of the opaque pixels) of the character image, for
+                composite_characters(). These are views into the bank, so they must not be modified.
+        """
+        glyphs = self.glyphs[(c, size)]
+        index = rng.randrange(len(glyphs))
+
+        return glyphs[index, ..., :3], self.masks[(c, size)][index]
+
+
 # TODO: Add random left/right diagonal white lines across characters?
-def synthesize_captcha(background: cv2.UMat, x_list: list[int], y_list: list[int], size: tuple[int, int], outdir: str):
+def render_captcha(background: cv2.UMat, x_list: list[int], y_list: list[int], size: tuple[int, int],
+                   label: str, glyphs: GlyphBank, rng: random.Random = random, out: np.ndarray = None) -> np.ndarray:
     """
-    Generate a single synthetic CAPTCHA image, using the given background image
-    and character location info. The generated image will be saved in the outdir.
+    Render a single synthetic CAPTCHA image in memory, using the given background image
+    and character location info.
 
     @param background Background OpenCV image to use.
     @param x_list List of x positions for each character
     @param y_list List of y positions for each character
     @param size (width, height) size to make each character image
-    @param outdir Directory to save the image
+    @param label The solution text to draw, one character per x/y position
+    @param glyphs GlyphBank to draw the character images from.
+    @param rng Random instance for the character image choice and jitter.
+    @param out Optional (80, 300, 3) uint8 buffer to render into, instead of a new image.
+    @return The (80, 300, 3) BGR image.
     """
     # Make sure it's the right size.
-    background = cv2.resize(background, (300, 80), interpolation=cv2.INTER_NEAREST)
-    label = generate_unique_label(len(x_list), outdir)
+    background = cv2.resize(background, (300, 80), dst=out, interpolation=cv2.INTER_NEAREST)
 
+    characters = []
     for x, y, c in zip(x_list, y_list, label):
-        # Load a random image for the given char.
-        random_filename = random.choice(os.listdir(os.path.join(LABELS_DIR, c)))
-        random_path = os.path.join(LABELS_DIR, c, random_filename)
+        # Pick a random image for the given char.
+        colors, mask = glyphs.sample_masked(c, size, rng)
 
-        img = cv2.imread(random_path)
-        img = cv2.resize(img, size, interpolation=cv2.INTER_NEAREST)
+        # Stick the character image on top of the background, with a little bit of x/y jitter.
+        characters.append((colors, mask, x + rng.randint(-1, 2), y + rng.randint(-5, 5)))
 
-        # Alpha of 0 if black, 255 if white.
-        alpha = np.uint8(np.where(img[..., -1] == 0, 255, 0))
+    return composite_characters(background, characters)
 
-        # Merge in that alpha channel.
-        img = np.dstack((img, alpha))
+def synthesize_captcha(background: cv2.UMat, x_list: list[int], y_list: list[int], size: tuple[int, int],
+                       label: str, outdir: str, glyphs: GlyphBank):
+    """
+    Generate a single synthetic CAPTCHA image, using the given background image
+    and character location info. The generated image will be saved in the outdir.
 
-        # Stick the character image on top of the background, with a little bit of x/y jitter.
-        out = place_character_image(
-            background, img,
-            x + random.randint(-1, 2),
-            y + random.randint(-5, 5)
-        )
+    @param background Background OpenCV image to use.
+    @param x_list List of x positions for each character
+    @param y_list List of y positions for each character
+    @param size (width, height) size to make each character image
+    @param label The solution text to draw, one character per x/y position
+    @param outdir Directory to save the image
+    @param glyphs GlyphBank to draw the character images from.
+    """
+    out = render_captcha(background, x_list, y_list, size, label, glyphs)
 
     cv2.imwrite(os.path.join(outdir, f"{label}.png"), out)
 
+def iter_synthetic_captchas(glyphs: GlyphBank, bank: np.ndarray, seed: int = None) -> Iterator[tuple[np.ndarray, str]]:
+    """
+    Endlessly generate synthetic CAPTCHAs in memory, for training on the fly.
+    Labels are drawn independently, so unlike the files on disk they may repeat.
+
+    @param glyphs GlyphBank to draw the character images from.
+    @param bank Background bank returned by load_background_bank().
+    @param seed Seed for the generated CAPTCHAs, or None for a random one.
+    @return Iterator of ((80, 300, 3) BGR image, label) tuples.
+    """
+    rng = random.Random(seed)
+    choices = range(len(LAYOUTS))
+
+    while True:
+        layout = LAYOUTS[rng.choices(choices, weights=LAYOUT_WEIGHTS)[0]]
+        label = ''.join(rng.choice(CHARACTER_SET[1:]) for _ in layout['x'])
+
+        background = sample_background(bank, rng)
+
+        yield render_captcha(background, layout['x'], layout['y'], layout['size'], label, glyphs, rng), label
+
+# Per-process state for the synthesis workers, set up by init_worker().
+_worker_paths = None
+_worker_bank = None
+_worker_glyphs = None
+
+def init_worker(paths: list[str], labels_dir: str, bank_path: str = None):
+    """
+    Set up a synthesis worker process, loading the glyph bank once for all of its shards.
+
+    @param paths List of background source image paths. Unused if there is a background bank.
+    @param labels_dir Directory containing the character images.
+    @param bank_path Path of a background bank to sample backgrounds from, instead of extracting them.
+    """
+    global _worker_paths, _worker_bank, _worker_glyphs
+
+    _worker_paths = paths
+    _worker_bank = load_background_bank(bank_path) if bank_path is not None else None
+    _worker_glyphs = GlyphBank(labels_dir)
+
+def synthesize_shard(shard: tuple[int, list[tuple[int, str]], str]) -> tuple[int, Timings]:
+    """
+    Generate one shard of the synthetic dataset. This runs in the worker processes.
+    The shard's seed fully determines the images generated from its plan, whichever worker runs it.
+
+    @param shard Tuple of (seed, list of (LAYOUTS index, label) to generate, output directory).
+    @return Tuple of (the number of images generated, Timings of the stages).
+    """
+    seed, plan, outdir = shard
+    random.seed(seed)
+    timings = Timings()
+
+    # Every image is written out before the next one is rendered, so they can all be rendered in the same buffer.
+    buffer = np.empty((80, 300, 3), dtype=np.uint8)
+
+    for layout_index, label in plan:
+        layout = LAYOUTS[layout_index]
+
+        if _worker_bank is not None:
+            with timings.stage('sample_background'):
+                background = sample_background(_worker_bank)
+        else:
+            with timings.stage('imread'):
+                background_source = cv2.imread(random.choice(_worker_paths))
+            with timings.stage('isolate_background'):
+                background = isolate_background(background_source)
+
+        # The same as synthesize_captcha(), split up to time the stages.
+        with timings.stage('render_captcha'):
+            out = render_captcha(background, layout['x'], layout['y'], layout['size'], label, _worker_glyphs,
+                                 out=buffer)
+        with timings.stage('imwrite'):
+            cv2.imwrite(os.path.join(outdir, f"{label}.png"), out)
+
+    return len(plan), timings
+
+def plan_shards(number: int, shard_size: int, seed: int, outdir: str) -> Iterator[tuple[int, list[tuple[int, str]], str]]:
+    """
+    Lazily plan the shards of a synthetic dataset: the layout, label and seed of every image.
+    Labels are tracked in memory across all shards, so they are unique without probing the filesystem.
+
+    @param number Total number of images to generate.
+    @param shard_size Number of images per shard.
+    @param seed Seed for the whole dataset.
+    @param outdir Directory the images will be stored in. Labels of images already in there are not reused.
+    """
+    rng = random.Random(seed)
+    used = {os.path.splitext(f)[0] for f in os.listdir(outdir) if f.endswith('.png')}
+
+    for start in range(0, number, shard_size):
+        layouts = rng.choices(range(len(LAYOUTS)), weights=LAYOUT_WEIGHTS, k=min(shard_size, number - start))
+        plan = [(i, generate_unique_label(len(LAYOUTS[i]['x']), used, rng)) for i in layouts]
+
+        yield rng.getrandbits(64), plan, outdir
+
 def main():
     parser = argparse.ArgumentParser(
         prog='4chan-captcha-synthesizer'
     )
-    parser.add_argument('-b', '--backgrounds', action='store', required=True,
-                        help='The root of the directory tree containing images to extract backgrounds from.')
+    backgrounds = parser.add_mutually_exclusive_group(required=True)
+    backgrounds.add_argument('-b', '--backgrounds', action='store',
+                             help='The root of the directory tree containing images to extract backgrounds from.')
+    backgrounds.add_argument('-B', '--background-bank', action='store',
+                             help='A background bank written by extract_backgrounds.py, to sample backgrounds from.')
     parser.add_argument('-n', '--number', action='store', required=True,
                         help='The number of synthetic CAPTCHAs to generate.')
     parser.add_argument('-o', '--out', action='store', required=True,
                         help='The directory to store images in.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=1,
+                        help='How many worker processes to use. Defaults to 1.')
+    parser.add_argument('-s', '--seed', action='store', type=int, default=None,
+                        help='Seed for the dataset. The same seed always generates the same images. '
+                             'Defaults to a random seed.')
+    parser.add_argument('--shard-size', action='store', type=int, default=1000,
+                        help='How many images each shard generates. Changing it changes the dataset. Defaults to 1000.')
 
     args = parser.parse_args()
 
     if not os.path.exists(args.out):
         os.mkdir(args.out)
 
-    paths = walk_png_files(args.backgrounds)
-
-    for _ in range(int(args.number)):
-        layout = np.random.choice(
-            LAYOUTS, 1,
-            # We have fewer 5-char layouts in the LAYOUTS array, so weight them a little heavier.
-            p=[0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.2, 0.2]
-        )[0]
-
-        background_source = cv2.imread(random.choice(paths))
-        background = isolate_background(background_source)
-
-        synthesize_captcha(
-            background, layout['x'], layout['y'], layout['size'], args.out
-        )
+    seed = args.seed if args.seed is not None else random.getrandbits(32)
+    print(f"Using seed {seed}")
+
+    # Sorted, so the same seed picks the same backgrounds no matter the directory listing order.
+    paths = sorted(walk_png_files(args.backgrounds)) if args.backgrounds else []
+    shards = plan_shards(int(args.number), args.shard_size, seed, args.out)
+
+    # The per-stage timings are printed at exit, so an interrupted run still shows them.
+    timings = Timings()
+    timings.report_at_exit()
+
+    start = time.perf_counter()
+    done = 0
+
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(paths, LABELS_DIR, args.background_bank)) as pool:
+            for count, shard_timings in pool.imap_unordered(synthesize_shard, shards):
+                done += count
+                timings.merge(shard_timings)
+                print(f"Generated {done}/{args.number}")
+    else:
+        init_worker(paths, LABELS_DIR, args.background_bank)
+        for shard in shards:
+            count, shard_timings = synthesize_shard(shard)
+            done += count
+            timings.merge(shard_timings)
+            print(f"Generated {done}/{args.number}")
+
+    elapsed = time.perf_counter() - start
+    print(f"Generated {done} images in {elapsed:.1f}s ({done / elapsed if elapsed > 0 else 0:.1f} images/s)")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,82 @@
+"""
+A lightweight timing and counter facility, to see where the time goes in the preprocessing scripts.
+
+Named stages are timed with Timings.stage(), and summarized per stage as the count, total, p50 and p95 of their
+durations. Worker processes time their own work into a Timings of their own and send it back with their results,
+for the main process to merge(). Like common_lite.py, this must not import TensorFlow.
+"""
+import sys
+import time
+import array
+import atexit
+import contextlib
+
+from typing import Iterator, TextIO
+
+import numpy as np
+
+class Timings:
+    """ Durations of named stages, and named counters. """
+
+    def __init__(self):
+        # Durations in seconds, kept as packed doubles so millions of them stay cheap.
+        self.durations: dict[str, array.array] = {}
+        self.counters: dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time the code in the with block as one run of the named stage.
+        Nothing is recorded if the block raises an exception.
+        """
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        """ Record one run of the named stage, that took the given number of seconds. """
+        if name not in self.durations:
+            self.durations[name] = array.array('d')
+
+        self.durations[name].append(seconds)
+
+    def count(self, name: str, n=1):
+        """ Add n to the named counter. """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other: 'Timings'):
+        """ Add all of the durations and counters of another Timings, like one from a worker process, to this one. """
+        for name, durations in other.durations.items():
+            if name not in self.durations:
+                self.durations[name] = array.array('d')
+
+            self.durations[name].extend(durations)
+
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def summary(self) -> str:
+        """ Get a table of the count, total, p50 and p95 of every stage, followed by the counters. """
+        lines = [f"{'stage':<24}{'count':>10}{'total s':>12}{'p50 ms':>10}{'p95 ms':>10}"]
+
+        for name, durations in self.durations.items():
+            values = np.frombuffer(durations, dtype=np.float64) * 1000
+            p50, p95 = np.percentile(values, [50, 95])
+            lines.append(f"{name:<24}{len(values):>10}{values.sum() / 1000:>12.2f}{p50:>10.2f}{p95:>10.2f}")
+
+        for name, n in self.counters.items():
+            lines.append(f"{name:<24}{n:>10}")
+
+        return '\n'.join(lines)
+
+    def report_at_exit(self, file: TextIO = None):
+        """
+        Print the summary when the process exits, even if it's interrupted.
+        Stage times are summed over all workers, so they can add up to more than the wall-clock time.
+        @param file File to print to. Defaults to stderr.
+        """
+        def report():
+            if self.durations or self.counters:
+                print(self.summary(), file=file or sys.stderr)
+
+        atexit.register(report)